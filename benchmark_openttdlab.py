@@ -0,0 +1,229 @@
+import argparse
+import json
+import lzma
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import zlib
+
+from openttdlab import iter_savegame, parse_savegame, query_savegame
+
+
+# Benchmarks of parsing savegames, run using
+#
+#   python benchmark_openttdlab.py --output results.json
+#
+# and to compare against the results of a previous run, for example of a different commit,
+#
+#   python benchmark_openttdlab.py --output results.json --compare previous-results.json
+#
+# which exits with a non-zero code if any throughput drops by more than --threshold
+
+
+FIXTURE = './fixtures/warbourne-cross-transport-2029-01-06.sav'
+PARALLEL_WORKERS = 4
+
+
+def _encodings(fixture_path):
+    # The fixture is OTTX (LZMA compressed), and is re-encoded using the other formats
+    # that OpenTTD supports so each can be benchmarked from the same contents
+    with open(fixture_path, 'rb') as f:
+        contents = f.read()
+    if contents[:4] != b'OTTX':
+        raise Exception('Expected an OTTX fixture')
+
+    header = contents[4:8]
+    decompressed = lzma.decompress(contents[8:])
+    return decompressed, {
+        'OTTN': b'OTTN' + header + decompressed,
+        'OTTZ': b'OTTZ' + header + zlib.compress(decompressed),
+        'OTTX': contents,
+    }
+
+
+def _median_seconds(func, repeats):
+    def timed():
+        start = time.perf_counter()
+        func()
+        return time.perf_counter() - start
+
+    func()  # Warm up, e.g. so compiled decoders are cached as they would be in a sweep
+    return statistics.median(timed() for _ in range(0, repeats))
+
+
+def _peak_memory_bytes(func):
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _records_per_second_by_tag(path, repeats):
+    seconds_by_tag = {}
+    records_by_tag = {}
+    for _ in range(0, repeats):
+        with iter_savegame(path) as (_, chunks):
+            start = time.perf_counter()
+            for tag, headers, records in chunks:
+                num_records = sum(1 for _ in records)
+                end = time.perf_counter()
+                seconds_by_tag.setdefault(tag, []).append(end - start)
+                records_by_tag[tag] = num_records
+                start = end
+
+    return {
+        tag: records_by_tag[tag] / statistics.median(seconds)
+        for tag, seconds in seconds_by_tag.items()
+        if records_by_tag[tag]
+    }
+
+
+def _import_seconds(repeats):
+    # Each import is in a new process, as it would be in each worker or short-lived job. Only the
+    # import itself is timed, not starting the interpreter. It's run from the directory of this
+    # file so openttdlab is importable whichever directory the benchmarks are run from
+    code = 'import time; start = time.perf_counter(); import openttdlab; print(time.perf_counter() - start)'
+    return statistics.median(
+        float(subprocess.check_output((sys.executable, '-c', code), text=True, cwd=os.path.dirname(os.path.abspath(__file__))))
+        for _ in range(0, repeats)
+    )
+
+
+def run_benchmarks(fixture_path, repeats):
+    decompressed, encodings = _encodings(fixture_path)
+    decompressed_mb = len(decompressed) / 1000000
+    results = {}
+
+    with tempfile.TemporaryDirectory() as d:
+        for compression, contents in encodings.items():
+            path = os.path.join(d, f'{compression}.sav')
+            with open(path, 'wb') as f:
+                f.write(contents)
+
+            def parse_path():
+                parse_savegame(path)
+
+            def parse_stream():
+                with open(path, 'rb') as f:
+                    parse_savegame(iter(lambda: f.read(65536), b''))
+
+            def parse_pipelined():
+                parse_savegame(path, pipelined=True)
+
+            def parse_columns():
+                parse_savegame(path, output='columns')
+
+            def parse_parallel():
+                # Workers are reused between calls, so after the warm up this doesn't include
+                # starting them
+                parse_savegame(path, max_workers=PARALLEL_WORKERS)
+
+            def parse_date_only():
+                parse_savegame(path, chunk_tags=('DATE',))
+
+            def query_fields():
+                query_savegame(path, ('DATE.0.date', 'PLYR.*.money', 'PLYR.*.cur_economy.income'))
+
+            for name, func in (
+                ('path', parse_path),
+                ('stream', parse_stream),
+                ('pipelined', parse_pipelined),
+                ('columns', parse_columns),
+                ('parallel', parse_parallel),
+                ('date_only', parse_date_only),
+                ('query', query_fields),
+            ):
+                try:
+                    seconds = _median_seconds(func, repeats)
+                except ImportError:
+                    # For example if NumPy isn't installed for the columns benchmark
+                    continue
+                results[f'{compression}.{name}'] = {
+                    'seconds': seconds,
+                    'decompressed_mb_per_second': decompressed_mb / seconds,
+                    'peak_memory_bytes': _peak_memory_bytes(func),
+                }
+
+        results['OTTN.records_per_second_by_tag'] = _records_per_second_by_tag(os.path.join(d, 'OTTN.sav'), repeats)
+
+    import_seconds = _import_seconds(repeats)
+    results['import'] = {
+        'seconds': import_seconds,
+        'imports_per_second': 1 / import_seconds,
+    }
+
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(('git', 'rev-parse', 'HEAD'), stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _compare(previous, current, threshold):
+    # Returns the benchmarks where throughput has dropped by more than threshold
+    regressions = []
+    for name, result in current['results'].items():
+        previous_result = previous['results'].get(name)
+        if previous_result is None:
+            continue
+        throughputs = \
+            result.items() if name.endswith('by_tag') else \
+            ((key, value) for key, value in result.items() if key.endswith('per_second'))
+        previous_throughputs = previous_result
+        for key, throughput in throughputs:
+            if key not in previous_throughputs:
+                continue
+            ratio = throughput / previous_throughputs[key]
+            print(f'{name} {key}: {ratio:.2f}x')
+            if ratio < 1 - threshold:
+                regressions.append((name, key, ratio))
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fixture', default=FIXTURE)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--output', required=True)
+    parser.add_argument('--compare', default=None)
+    parser.add_argument('--threshold', type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    current = {
+        'commit': _git_commit(),
+        'python_version': platform.python_version(),
+        'platform': platform.platform(),
+        'fixture': args.fixture,
+        'results': run_benchmarks(args.fixture, args.repeats),
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(current, f, indent=2)
+
+    for name, result in current['results'].items():
+        if name == 'import':
+            print(f"{name}: {result['seconds'] * 1000:.1f} ms")
+        elif not name.endswith('by_tag'):
+            print(f"{name}: {result['decompressed_mb_per_second']:.1f} MB/s, peak memory {result['peak_memory_bytes']} bytes")
+
+    if args.compare is not None:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            previous = json.load(f)
+        regressions = _compare(previous, current, args.threshold)
+        if regressions:
+            for name, key, ratio in regressions:
+                print(f'Regression: {name} {key} is {ratio:.2f}x of previous')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -5,6 +5,8 @@
 # OpenTTDLab is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
 # See the GNU General Public License for more details. You should have received a copy of the GNU General Public License along with OpenTTDLab. If not, see <http://www.gnu.org/licenses/>.
 
+import argparse
+import atexit
 import contextlib
 import enum
 import hashlib
@@ -12,9 +14,12 @@ import itertools
 import io
 import json
 import lzma
+import mmap
 import os
 import os.path
+import pickle
 import platform
+import queue
 import re
 import shutil
 import stat
@@ -25,26 +30,32 @@ import sys
 import tarfile
 import tempfile
 import textwrap
+import threading
+import time
+import types
 import uuid
 import zipfile
 import zlib
 from collections import defaultdict, deque
+from collections.abc import Mapping
 from datetime import date, timedelta
 from functools import partial
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from pathlib import Path
 from urllib.parse import urlparse
-from rich.progress import MofNCompleteColumn, BarColumn, SpinnerColumn, TextColumn, Progress
 
-import httpx
-import yaml
-from dill import dumps, loads
-from platformdirs import user_cache_dir
+# The third party dependencies httpx, yaml, rich, dill and platformdirs are imported in the functions
+# that use them, so only parsing savegames doesn't pay the cost of importing them
 
 
 # On release this is replaced by the release's corresponding git tag
 __version__ = '0.0.0.dev0'
 
+# Part of the key of cached parsed savegames, so should be incremented if the output of parsing
+# changes, which isn't reflected in __version__ during development
+_SAVEGAME_PARSER_VERSION = 1
+
 
 CONTENT_TYPE_BASE_GRAPHICS = 1
 CONTENT_TYPE_NEWGRF        = 2
@@ -80,18 +91,63 @@ LICENSES_THAT_ALLOW_EXACT_VERSION_DOWNLOAD = {
     'CC-BY-NC-ND v3.0',
 }
 
-def run_experiments(
+def _http_client():
+    import httpx
+    return httpx.Client(transport=httpx.HTTPTransport(retries=3))
+
+
+def _user_cache_dir():
+    from platformdirs import user_cache_dir
+    return user_cache_dir(appname='OpenTTDLab', version=__version__, ensure_exists=True)
+
+
+def run_experiments(*args, sink=None, **kwargs):
+    # Takes the same arguments as iter_experiments. With a sink, the rows of each experiment are
+    # written to it as soon as the experiment finishes, and a function to read them back is returned
+    if sink is not None:
+        open_writer, read_rows = sink
+        with open_writer() as write:
+            for experiment_index, rows in itertools.groupby(iter_experiments(*args, **kwargs), key=lambda i_and_row: i_and_row[0]):
+                write(experiment_index, [row for _, row in rows])
+        return read_rows
+
+    # Otherwise all the rows are returned in the order of the experiments, and for each experiment
+    # in the order of its savegames
+    return [
+        row
+        for _, row in sorted(iter_experiments(*args, **kwargs), key=lambda i_and_row: i_and_row[0])
+    ]
+
+
+def iter_experiments(
     experiments=(),
     ai_libraries=(),
     final_screenshot_directory=None,
+    final_savegame_directory=None,
     max_workers=None,
     openttd_version=None,
     opengfx_version=None,
     openttd_cdn_url='https://cdn.openttd.org/',
     result_processor=lambda x: (x,),
-    get_http_client=lambda: httpx.Client(transport=httpx.HTTPTransport(retries=3)),
-    get_cache_dir=lambda: user_cache_dir(appname='OpenTTDLab', version=__version__, ensure_exists=True),
+    chunk_tags=None,
+    fields=None,
+    parse_cache=False,
+    parse_cache_max_bytes=1000000000,
+    parse_stats_callback=None,
+    compact_records=False,
+    savegame_deltas=False,
+    lazy=False,
+    parse_while_running=False,
+    run_dir_root=None,
+    experiment_cache=False,
+    experiment_cache_max_bytes=1000000000,
+    get_http_client=lambda: _http_client(),
+    get_cache_dir=lambda: _user_cache_dir(),
 ):
+    import yaml
+    from dill import dumps, loads
+    from rich.progress import MofNCompleteColumn, BarColumn, SpinnerColumn, TextColumn, Progress
+
     def get(client, url):
         response = client.get(url)
         response.raise_for_status()
@@ -227,7 +283,13 @@ def run_experiments(
 
         run_id = str(uuid.uuid4())
         experiments_list = list(experiments)
-        with tempfile.TemporaryDirectory(prefix=f'OpenTTDLab-{run_id}-') as run_dir:
+        chunk_tags, fields = _chunk_tags_and_fields(chunk_tags, fields)
+        if savegame_deltas and (fields is not None or parse_cache):
+            raise ValueError('savegame_deltas cannot be used with fields or parse_cache')
+        if lazy and (fields is not None or parse_cache or savegame_deltas or parse_while_running):
+            raise ValueError('lazy cannot be used with fields, parse_cache, savegame_deltas or parse_while_running')
+        parse_cache_dir_and_max_bytes = (cache_dir, parse_cache_max_bytes) if parse_cache else None
+        with tempfile.TemporaryDirectory(prefix=f'OpenTTDLab-{run_id}-', dir=run_dir_root) as run_dir:
             # Extract the binaries into the run dir
             openttd_binary_dir = os.path.join(run_dir, f'{openttd_filename}')
             opengfx_binary_dir = os.path.join(run_dir, f'{opengfx_filename}')
@@ -253,25 +315,30 @@ def run_experiments(
                 for experiment in experiments_list
                 for ai_name, ai_params, ai_copy in experiment.get('ais', [])
             }
-            ai_and_library_filenames = [
-                ai_copy
-                for ai_copy in ai_copy_functions.values()
-            ] + [
-                ai_library_copy
+            def copy_ai_or_library_to_run_dir(copy_func):
+                with copy_func(get_http_client=lambda: contextlib.nullcontext(client), get_cache_dir=lambda: cache_dir) as filenames_and_data:
+                    for content_id, filename, license, md5sum, get_data in filenames_and_data:
+                        path = content_types_by_str[content_id.split('/')[0]][1]
+                        with \
+                                get_data() as data, \
+                                open(os.path.join(run_dir, filename), 'wb') as f:
+                            for chunk in data:
+                                f.write(chunk)
+                        yield path, filename
+            ai_filenames = {
+                ai_name: tuple(copy_ai_or_library_to_run_dir(ai_copy))
+                for ai_name, ai_copy in ai_copy_functions.items()
+            }
+            ai_library_filenames = tuple(
+                path_and_filename
                 for _, ai_library_copy in ai_libraries
-            ]
-            def copy_ai_or_library_to_run_dir():
-                for copy_func in ai_and_library_filenames:
-                    with copy_func(get_http_client=lambda: contextlib.nullcontext(client), get_cache_dir=lambda: cache_dir) as filenames_and_data:
-                        for content_id, filename, license, md5sum, get_data in filenames_and_data:
-                            path = content_types_by_str[content_id.split('/')[0]][1]
-                            with \
-                                    get_data() as data, \
-                                    open(os.path.join(run_dir, filename), 'wb') as f:
-                                for chunk in data:
-                                    f.write(chunk)
-                            yield path, filename
-            ai_and_library_filenames = tuple(copy_ai_or_library_to_run_dir())
+                for path_and_filename in copy_ai_or_library_to_run_dir(ai_library_copy)
+            )
+            ai_and_library_filenames = tuple(
+                path_and_filename
+                for filenames in ai_filenames.values()
+                for path_and_filename in filenames
+            ) + ai_library_filenames
 
             max_workers = \
                 max_workers if max_workers is not None else \
@@ -284,28 +351,143 @@ def run_experiments(
                         MofNCompleteColumn(),
                     ) as progress:
                 pool = Pool(processes=max_workers)
+                finished = False
                 try:
                     task = progress.add_task("Running experiments...", total=len(experiments_list))
-                    async_results = [
+                    result_processor_dumped = dumps(result_processor)
+                    completed = queue.Queue()
+
+                    # Experiments are cached by everything that affects their result rows, including
+                    # the contents of their own AIs, and of all the libraries since any of them can
+                    # be used. Adding an AI to other experiments doesn't change the key
+                    experiment_cache_dir = os.path.join(cache_dir, 'experiments')
+                    if experiment_cache:
+                        Path(experiment_cache_dir).mkdir(parents=True, exist_ok=True)
+
+                        def get_sha256s(filenames):
+                            return sorted(
+                                (filename, _file_sha256(os.path.join(run_dir, filename)))
+                                for _, filename in filenames
+                            )
+
+                        ai_sha256s = {
+                            ai_name: get_sha256s(filenames)
+                            for ai_name, filenames in ai_filenames.items()
+                        }
+                        ai_library_sha256s = get_sha256s(ai_library_filenames)
+                        result_processor_sha256 = _function_sha256(result_processor, result_processor_dumped)
+                    experiment_cache_files = {}
+
+                    def experiment_cache_file(experiment):
+                        key = hashlib.sha256(json.dumps({
+                            'openttdlab_version': __version__,
+                            'savegame_parser_version': _SAVEGAME_PARSER_VERSION,
+                            'openttd_version': openttd_version,
+                            'opengfx_version': opengfx_version,
+                            'experiment': {key: value for key, value in experiment.items() if key != 'ais'},
+                            'ais': [
+                                (ai_name, list(ai_params), ai_sha256s[ai_name])
+                                for ai_name, ai_params, _ in experiment.get('ais', [])
+                            ],
+                            'ai_library_sha256s': ai_library_sha256s,
+                            'result_processor_sha256': result_processor_sha256,
+                            'options': [
+                                chunk_tags, fields, compact_records, savegame_deltas, lazy,
+                                final_screenshot_directory is not None,
+                                final_savegame_directory is not None,
+                            ],
+                        }, sort_keys=True, default=str).encode()).hexdigest()
+                        return os.path.join(experiment_cache_dir, f'{key}.pickle')
+
+                    def get_cached(cached_file, experiment):
+                        try:
+                            with open(cached_file, 'rb') as f:
+                                rows, screenshot, savegame = pickle.load(f)
+                        except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+                            return None
+                        # The modification time is the time last used, for least recently used eviction
+                        try:
+                            os.utime(cached_file)
+                        except OSError:
+                            pass
+                        if screenshot is not None:
+                            with open(os.path.join(final_screenshot_directory, str(experiment['seed']) + '.png'), 'wb') as f:
+                                f.write(screenshot)
+                        if savegame is not None:
+                            with open(os.path.join(final_savegame_directory, str(experiment['seed']) + '.sav'), 'wb') as f:
+                                f.write(savegame)
+                        return rows
+
+                    def set_cached(i, experiment, rows):
+                        screenshot = None
+                        if final_screenshot_directory is not None:
+                            with open(os.path.join(final_screenshot_directory, str(experiment['seed']) + '.png'), 'rb') as f:
+                                screenshot = f.read()
+                        savegame = None
+                        if final_savegame_directory is not None:
+                            with open(os.path.join(final_savegame_directory, str(experiment['seed']) + '.sav'), 'rb') as f:
+                                savegame = f.read()
+                        # Written to a temporary file first so concurrent readers never see a partial file
+                        with tempfile.NamedTemporaryFile('wb', dir=experiment_cache_dir, suffix='.tmp', delete=False) as f:
+                            pickle.dump((rows, screenshot, savegame), f, protocol=pickle.HIGHEST_PROTOCOL)
+                        cached_file = experiment_cache_files.pop(i)
+                        os.replace(f.name, cached_file)
+                        _evict_least_recently_used(experiment_cache_dir, experiment_cache_max_bytes, os.path.getsize(cached_file))
+
+                    def submit(i, experiment):
+                        if experiment_cache:
+                            experiment_cache_files[i] = experiment_cache_file(experiment)
+                            rows = get_cached(experiment_cache_files[i], experiment)
+                            if rows is not None:
+                                del experiment_cache_files[i]
+                                completed.put((True, i, rows))
+                                return
                         pool.apply_async(
                             _run_experiment,
                             args=(
-                                opengfx_binary, openttd_binary, final_screenshot_directory,
-                                openttd_version, opengfx_version, dumps(result_processor),
+                                opengfx_binary, openttd_binary, final_screenshot_directory, final_savegame_directory,
+                                openttd_version, opengfx_version, result_processor_dumped,
                                 run_dir, i, dumps(experiment), ai_and_library_filenames,
-                                xvfb_run_available, data_extraction_mode,
+                                xvfb_run_available, data_extraction_mode, chunk_tags, fields,
+                                parse_cache_dir_and_max_bytes, parse_stats_callback is not None, compact_records,
+                                savegame_deltas, lazy, parse_while_running,
                             ),
-                            callback=partial(run_done, progress, task),
+                            callback=lambda rows: completed.put((True, i, rows)),
+                            error_callback=lambda e: completed.put((False, i, e)),
                         )
-                        for i, experiment in enumerate(experiments_list)
-                    ]
-
-                    return [
-                        savegame_row
-                        for savegame_rows_async_result in async_results
-                        for savegame_row in loads(savegame_rows_async_result.get())
-                    ]
+
+                    # Only a bounded number of experiments are submitted to the pool at any one time,
+                    # so the rows of experiments that have finished but not yet been yielded don't
+                    # build up in memory
+                    enumerated_experiments = enumerate(experiments_list)
+                    in_flight = 0
+                    for i, experiment in itertools.islice(enumerated_experiments, max_workers * 2):
+                        submit(i, experiment)
+                        in_flight += 1
+
+                    while in_flight:
+                        success, i, rows_or_exception = completed.get()
+                        in_flight -= 1
+                        if not success:
+                            raise rows_or_exception
+                        run_done(progress, task, None)
+
+                        for next_i, next_experiment in itertools.islice(enumerated_experiments, 1):
+                            submit(next_i, next_experiment)
+                            in_flight += 1
+
+                        if i in experiment_cache_files:
+                            set_cached(i, experiments_list[i], rows_or_exception)
+                        experiment_savegame_rows, parse_stats = loads(rows_or_exception)
+                        if parse_stats_callback is not None:
+                            parse_stats_callback(experiments_list[i], parse_stats)
+                        for savegame_row in experiment_savegame_rows:
+                            yield i, savegame_row
+                    finished = True
                 finally:
+                    # If stopped early, for example on error, experiments still running are not waited for
+                    if not finished:
+                        pool.terminate()
                     # Not calling these explicitly can result in code coverage not measuring
                     # subprocesses. Even using Pool as a context manager doesn't call these
                     pool.close()
@@ -313,35 +495,69 @@ def run_experiments(
 
 
 def _run_experiment(
-        opengfx_binary, openttd_binary, final_screenshot_directory,
+        opengfx_binary, openttd_binary, final_screenshot_directory, final_savegame_directory,
         openttd_version, opengfx_version, result_processor,
         run_dir, i, experiment, ai_and_library_filenames,
-        xvfb_run_available, data_extraction_mode,
+        xvfb_run_available, data_extraction_mode, chunk_tags, fields,
+        parse_cache_dir_and_max_bytes, collect_parse_stats, compact_records,
+        savegame_deltas, lazy, parse_while_running,
 ):
+    from dill import dumps, loads
+
     result_processor = loads(result_processor)
     experiment = loads(experiment)
 
-    def get_savegame_row(openttd_version, opengfx_version, experiment, filename, output):
-        with open(filename, 'rb') as f:
-            game = parse_savegame(iter(lambda: f.read(65536), b''))
+    # Statistics of each chunk tag are summed over all the savegames of the experiment
+    parse_stats = defaultdict(lambda: defaultdict(int)) if collect_parse_stats else None
+
+    def add_parse_stats(tag, stats):
+        for key, value in stats.items():
+            parse_stats[tag][key] += value
+
+    # With savegame_deltas each savegame is compared with the previous one of the experiment
+    previous_savegame = {}
+
+    def get_savegame_row_values(filename):
+        # Each savegame is deleted once parsed, so disk use doesn't grow with the number of savegames
+        row_values = \
+            _savegame_delta_row_values(
+                filename, chunk_tags, previous_savegame,
+                add_parse_stats if collect_parse_stats else None, compact_records,
+            ) if savegame_deltas else \
+            _parse_savegame_row_values(
+                filename, chunk_tags, fields, parse_cache_dir_and_max_bytes,
+                add_parse_stats if collect_parse_stats else None, compact_records, lazy,
+            )
+        os.remove(filename)
+        return row_values
 
-        # Python (and indeed, the gregorian calendar) doesn't have a year zero,
-        # and according to the OpenTTD source, year 1 was a leap year
-        days_since_year_zero = game['chunks']['DATE']['records']['0']['date']
-        days_since_year_one = days_since_year_zero - 366
+    def get_savegame_row(openttd_version, opengfx_version, experiment, savegame_row_values, output):
         return result_processor({
             'openttd_version': openttd_version,
             'opengfx_version': opengfx_version,
-            'savegame_version': game['savegame_version'],
             'experiment': experiment,
-            'date': date(1, 1 , 1) + timedelta(days_since_year_one),
             'error': 'The script died unexpectedly' in output,
             'output': output,
-            'chunks': {
-                tag: chunk['records'] for tag, chunk in game['chunks'].items()
-            },
+            **savegame_row_values,
         })
 
+    # Parsed values of each savegame by filename. With parse_while_running, savegames are parsed
+    # while OpenTTD is still running. OpenTTD writes one savegame at a time, so all but the most
+    # recently modified savegame are complete
+    savegame_row_values = {}
+
+    def parse_new_savegames(include_latest):
+        try:
+            direntries = sorted((
+                direntry
+                for direntry in os.scandir(save_dir)
+                if direntry.is_file() and direntry.name not in savegame_row_values
+            ), key=lambda direntry: (direntry.stat().st_mtime_ns, direntry.name))
+        except FileNotFoundError:
+            return
+        for direntry in direntries if include_latest else direntries[:-1]:
+            savegame_row_values[direntry.name] = get_savegame_row_values(direntry.path)
+
     experiment_dir = os.path.join(run_dir, str(i))
     experiment_baseset_dir = os.path.join(experiment_dir, 'baseset')
     Path(experiment_baseset_dir).mkdir(parents=True)
@@ -357,9 +573,9 @@ def _run_experiment(
     seed = experiment['seed']
 
     # Populate run directory
-    shutil.copy(opengfx_binary, experiment_baseset_dir)
+    _link_or_copy(opengfx_binary, os.path.join(experiment_baseset_dir, os.path.basename(opengfx_binary)))
     for path, ai_or_library_filename in ai_and_library_filenames:
-        shutil.copy(
+        _link_or_copy(
             os.path.join(run_dir, ai_or_library_filename),
             os.path.join(experiment_dir, *path, ai_or_library_filename),
         )
@@ -393,31 +609,63 @@ def _run_experiment(
                 if month < months - 1:
                     f.write(f'schedule on-next-calendar-month {month+1:09}.scr\n')
 
-    # Run the experiment
-    ticks_per_day = 74
-    ticks = str(ticks_per_day * days)
-    output = subprocess.check_output(
-        (openttd_binary,) + (
-            '-g',                     # Start game immediately
-            '-G', str(seed),          # Seed for random number generator
-            '-snull',                 # No sound
-            '-mnull',                 # No music
-            '-vnull:ticks=' + ticks,  # No video, with fixed number of "ticks" and then exit
-            '-c', config_file,       # Config file
-        ),
-        cwd=experiment_dir,                  # OpenTTD looks in the current working directory for files
-        stderr=subprocess.STDOUT,
-        text=True,
-    )
-
     save_dir = \
         os.path.join(experiment_dir, 'save', 'autosave') if data_extraction_mode == 'autosave' else \
         os.path.join(experiment_dir, 'save')
-    save_filenames = sorted(list(
-        direntry.name
+
+    # Run the experiment. The output is written to a file rather than a pipe so it doesn't have to
+    # be read while OpenTTD is running
+    ticks_per_day = 74
+    ticks = str(ticks_per_day * days)
+    openttd_args = (openttd_binary,) + (
+        '-g',                     # Start game immediately
+        '-G', str(seed),          # Seed for random number generator
+        '-snull',                 # No sound
+        '-mnull',                 # No music
+        '-vnull:ticks=' + ticks,  # No video, with fixed number of "ticks" and then exit
+        '-c', config_file,       # Config file
+    )
+    with open(os.path.join(experiment_dir, 'output.txt'), 'w+', encoding='utf-8', errors='replace') as output_file:
+        process = subprocess.Popen(
+            openttd_args,
+            cwd=experiment_dir,                  # OpenTTD looks in the current working directory for files
+            stdout=output_file,
+            stderr=subprocess.STDOUT,
+        )
+        try:
+            while True:
+                try:
+                    process.wait(timeout=0.1 if parse_while_running else None)
+                    break
+                except subprocess.TimeoutExpired:
+                    parse_new_savegames(include_latest=False)
+        except BaseException:
+            process.kill()
+            process.wait()
+            raise
+        output_file.seek(0)
+        output = output_file.read()
+
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, openttd_args, output)
+
+    # Savegames already parsed while running have been deleted, and the final savegame for the
+    # screenshot is the most recently written of those that remain, which is never parsed while running
+    remaining_save_direntries = sorted((
+        direntry
         for direntry in os.scandir(save_dir)
         if direntry.is_file()
-    ))
+    ), key=lambda direntry: (direntry.stat().st_mtime_ns, direntry.name))
+    save_filenames = sorted(
+        set(direntry.name for direntry in remaining_save_direntries) | set(savegame_row_values.keys())
+    )
+
+    # The final savegame is kept before it's parsed and deleted
+    if final_savegame_directory is not None:
+        shutil.copyfile(
+            remaining_save_direntries[-1].path,
+            os.path.join(final_savegame_directory, str(seed) + '.sav'),
+        )
 
     if final_screenshot_directory is not None:
         with open(os.path.join(experiment_script_dir, 'game_start.scr'), 'w') as f:
@@ -426,7 +674,7 @@ def _run_experiment(
 
         subprocess.check_output(
             (('xvfb-run', '-a',) if xvfb_run_available else ()) + (openttd_binary,) + (
-                '-g', os.path.join(save_dir, save_filenames[-1]),
+                '-g', remaining_save_direntries[-1].path,
                 '-G', str(seed),          # Seed for random number generator
                 '-snull',                 # No sound
                 '-mnull',                 # No music
@@ -440,11 +688,95 @@ def _run_experiment(
             os.path.join(final_screenshot_directory, str(seed) + '.png'),
         )
 
-    return dumps([
+    if parse_while_running:
+        parse_new_savegames(include_latest=True)
+
+    result_rows = [
         result_row
         for filename in save_filenames
-        for result_row in get_savegame_row(openttd_version, opengfx_version, experiment, os.path.join(save_dir, filename), output)
-    ])
+        for result_row in get_savegame_row(
+            openttd_version, opengfx_version, experiment,
+            savegame_row_values.pop(filename) if filename in savegame_row_values else get_savegame_row_values(os.path.join(save_dir, filename)),
+            output,
+        )
+    ]
+
+    # The experiment directory isn't needed once the rows are built, so it's removed now rather
+    # than with the whole run directory after all experiments have finished
+    shutil.rmtree(experiment_dir)
+
+    return dumps((result_rows, None if parse_stats is None else {
+        tag: dict(stats) for tag, stats in parse_stats.items()
+    }))
+
+
+def _file_sha256(path):
+    file_sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1048576), b''):
+            file_sha256.update(block)
+    return file_sha256.hexdigest()
+
+
+def _function_sha256(func, dumped):
+    # Functions importable from a module are pickled by reference, so their bytecode is included
+    # to detect changes to them. Other functions are pickled by value, but the pickle can differ
+    # between processes, for example in the order of frozensets that depends on the hash seed, so
+    # they're hashed from their code, defaults and closure values instead. Code isn't marshalled
+    # since that depends on details such as which strings are interned. Changes to other functions
+    # that they call are not detected
+    seen_functions = set()
+
+    def update(value):
+        function_sha256.update(type(value).__name__.encode())
+        if isinstance(value, types.CodeType):
+            function_sha256.update(value.co_code)
+            update(value.co_names)
+            update(value.co_consts)
+        elif isinstance(value, types.FunctionType):
+            if id(value) in seen_functions:
+                return
+            seen_functions.add(id(value))
+            update(value.__code__)
+            update(value.__defaults__)
+            update(value.__kwdefaults__)
+            update(tuple(cell.cell_contents for cell in value.__closure__ or ()))
+        elif isinstance(value, (tuple, list)):
+            function_sha256.update(str(len(value)).encode())
+            for item in value:
+                update(item)
+        elif isinstance(value, (set, frozenset)):
+            update(sorted(value, key=repr))
+        elif isinstance(value, dict):
+            update(sorted(value.items(), key=repr))
+        else:
+            function_sha256.update(repr(value).encode())
+
+    def is_pickled_by_reference():
+        module = sys.modules.get(getattr(func, '__module__', None))
+        importable = module
+        for name in getattr(func, '__qualname__', '<locals>').split('.'):
+            importable = getattr(importable, name, None)
+        return module is not None and module.__name__ != '__main__' and importable is func
+
+    function_sha256 = hashlib.sha256()
+    if isinstance(func, types.FunctionType) and not is_pickled_by_reference():
+        update(func)
+    else:
+        function_sha256.update(dumped)
+        code = getattr(func, '__code__', None)
+        if code is not None:
+            update(code)
+    return function_sha256.hexdigest()
+
+
+def _link_or_copy(source, target):
+    # Hard links avoid a copy of each AI, library and base set for each experiment, but aren't
+    # possible between filesystems
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy(source, target)
 
 
 @contextlib.contextmanager
@@ -524,8 +856,8 @@ def remote_file(url, ai_name, ai_params=()):
 def download_from_bananas(
         content_id,
         md5=None,
-        get_http_client=lambda: httpx.Client(transport=httpx.HTTPTransport(retries=3)),
-        get_cache_dir=lambda: user_cache_dir(appname='OpenTTDLab', version=__version__, ensure_exists=True),
+        get_http_client=lambda: _http_client(),
+        get_cache_dir=lambda: _user_cache_dir(),
 ):
     @contextlib.contextmanager
     def tcp_connection(address):
@@ -769,7 +1101,749 @@ def bananas_ai_library(unique_id, ai_library_name, md5=None):
     return ai_library_name, partial(download_from_bananas, 'ai-library/' + unique_id, md5=md5)
 
 
-def parse_savegame(chunks, chunk_size=65536):
+class FieldType(enum.IntEnum):
+    END = 0
+    I8 = 1
+    U8 = 2
+    I16 = 3
+    U16 = 4
+    I32 = 5
+    U32 = 6
+    I64 = 7
+    U64 = 8
+    STRINGID = 9
+    STRING = 10
+    STRUCT = 11
+
+
+# The struct format characters of the field types that are always encoded in the same number of bytes
+_FIXED_WIDTH_FORMATS = {
+    FieldType.I8: 'b',
+    FieldType.U8: 'B',
+    FieldType.I16: 'h',
+    FieldType.U16: 'H',
+    FieldType.I32: 'l',
+    FieldType.U32: 'L',
+    FieldType.I64: 'q',
+    FieldType.U64: 'Q',
+    FieldType.STRINGID: 'H',
+}
+
+
+def _raise(e):
+    raise e
+
+
+def _gamma(buf, pos):
+    """
+    Read OTTD-savegame-style gamma value from buf at pos, returning it and the position after it.
+    """
+    b = buf[pos]
+    return \
+        (b & 0x7F, pos + 1) if (b & 0x80) == 0 else \
+        ((b & 0x3F) << 8 | buf[pos + 1], pos + 2) if (b & 0xC0) == 0x80 else \
+        ((b & 0x1F) << 16 | buf[pos + 1] << 8 | buf[pos + 2], pos + 3) if (b & 0xE0) == 0xC0 else \
+        ((b & 0x0F) << 24 | buf[pos + 1] << 16 | buf[pos + 2] << 8 | buf[pos + 3], pos + 4) if (b & 0xF0) == 0xE0 else \
+        ((b & 0x07) << 32 | int.from_bytes(buf[pos + 1:pos + 5], 'big'), pos + 5) if (b & 0xF8) == 0xF0 else \
+        _raise(ValidationException("Invalid gamma encoding."))
+
+
+def _parse_table_headers(header_bytes):
+    """Parses the headers for a table chunk."""
+    pos = 0
+
+    def read_fields():
+        nonlocal pos
+        while type := struct.unpack_from('>b', header_bytes, pos)[0]:
+            length, pos = _gamma(header_bytes, pos + 1)
+            pos += length
+            yield (
+                FieldType(type & 0xf),                              # Field type
+                bool(type & 0x10),                                  # Has length
+                str(header_bytes[pos - length:pos], 'utf-8'),       # Key
+            )
+        pos += 1
+
+    def read_substruct(header, parent_key):
+        for field_type, has_length, sub_key in header:
+            if field_type == FieldType.STRUCT:
+                sub_header = list(read_fields())
+                full_sub_key = f'{parent_key}.{sub_key}'
+                yield full_sub_key, sub_header
+                yield from read_substruct(sub_header, full_sub_key)
+
+    try:
+        root_header = list(read_fields())
+        sub_headers = list(read_substruct(root_header, "root"))
+    except (IndexError, struct.error):
+        raise ValidationException("Table header size mismatch.")
+
+    if pos != len(header_bytes):
+        raise ValidationException("Table header size mismatch.")
+
+    return {
+        "root": root_header,
+        **dict(sub_headers),
+    }
+
+
+class _RecordSchema:
+    """
+    The names of the fields of a CompactRecord, shared by all the records of the same table header
+    """
+
+    __slots__ = ('fields', 'indexes')
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.indexes = {field: i for i, field in enumerate(fields)}
+
+    def __eq__(self, other):
+        return isinstance(other, _RecordSchema) and self.fields == other.fields
+
+    def __hash__(self):
+        return hash(self.fields)
+
+    def __reduce__(self):
+        return (_RecordSchema, (self.fields,))
+
+
+class CompactRecord(Mapping):
+    """
+    A read-only record that supports the same lookups as a dict, for example record['money'], but
+    stores its values in a tuple alongside a schema of field names shared with other records
+    """
+
+    __slots__ = ('_schema', '_values')
+
+    def __init__(self, schema, values):
+        self._schema = schema
+        self._values = values
+
+    def __getitem__(self, key):
+        return self._values[self._schema.indexes[key]]
+
+    def __contains__(self, key):
+        return key in self._schema.indexes
+
+    def __iter__(self):
+        return iter(self._schema.fields)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __eq__(self, other):
+        return \
+            self._schema.fields == other._schema.fields and self._values == other._values if isinstance(other, CompactRecord) else \
+            dict(self.items()) == other if isinstance(other, dict) else \
+            NotImplemented
+
+    def __hash__(self):
+        return hash((self._schema, self._values))
+
+    def __repr__(self):
+        return f'CompactRecord({dict(self.items())!r})'
+
+    def __reduce__(self):
+        return (CompactRecord, (self._schema, self._values))
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return self._schema.fields
+
+    def values(self):
+        return self._values
+
+    def items(self):
+        return tuple(zip(self._schema.fields, self._values))
+
+
+def _compile_record_decoder(headers, key, compact=False):
+    """
+    Returns a function that decodes a record of the fields of headers[key] from buf at pos,
+    returning it and the position after it. Each run of consecutive fixed-width fields is
+    decoded by a single precompiled struct.Struct. If compact, the record is a CompactRecord,
+    lists are tuples, and strings are interned, so repeated strings across records are stored once.
+    """
+
+    def fixed_width_run(run_struct, sub_keys):
+        unpack_from = run_struct.unpack_from
+        size = run_struct.size
+
+        def decode(buf, pos, record):
+            record.update(zip(sub_keys, unpack_from(buf, pos)))
+            return pos + size
+
+        return decode
+
+    def string(sub_key):
+        def decode(buf, pos, record):
+            length, pos = _gamma(buf, pos)
+            record[sub_key] = str(buf[pos:pos + length], 'utf-8')
+            return pos + length
+
+        def decode_interned(buf, pos, record):
+            length, pos = _gamma(buf, pos)
+            record[sub_key] = sys.intern(str(buf[pos:pos + length], 'utf-8'))
+            return pos + length
+
+        return decode_interned if compact else decode
+
+    def list_of_fixed_width(sub_key, format_char):
+        size = struct.calcsize('>' + format_char)
+
+        def decode(buf, pos, record):
+            length, pos = _gamma(buf, pos)
+            record[sub_key] = list(struct.unpack_from(f'>{length}{format_char}', buf, pos))
+            return pos + length * size
+
+        def decode_tuple(buf, pos, record):
+            length, pos = _gamma(buf, pos)
+            record[sub_key] = struct.unpack_from(f'>{length}{format_char}', buf, pos)
+            return pos + length * size
+
+        return decode_tuple if compact else decode
+
+    def sub_record(sub_key, decode_sub_record):
+        def decode(buf, pos, record):
+            record[sub_key], pos = decode_sub_record(buf, pos)
+            return pos
+
+        return decode
+
+    def list_of_sub_records(sub_key, decode_sub_record):
+        def decode(buf, pos, record):
+            length, pos = _gamma(buf, pos)
+            sub_records = []
+            for _ in range(length):
+                item, pos = decode_sub_record(buf, pos)
+                sub_records.append(item)
+            record[sub_key] = tuple(sub_records) if compact else sub_records
+            return pos
+
+        return decode
+
+    def field_decoder(field_type, has_length, sub_key):
+        return \
+            string(sub_key) if field_type == FieldType.STRING else \
+            list_of_sub_records(sub_key, _compile_record_decoder(headers, f'{key}.{sub_key}', compact)) if field_type == FieldType.STRUCT and has_length else \
+            sub_record(sub_key, _compile_record_decoder(headers, f'{key}.{sub_key}', compact)) if field_type == FieldType.STRUCT else \
+            list_of_fixed_width(sub_key, _FIXED_WIDTH_FORMATS[field_type]) if field_type in _FIXED_WIDTH_FORMATS else \
+            _raise(ValidationException(f"Unsupported field type {field_type}."))
+
+    # Group the fields into runs of fixed-width fields and individual variable-width fields
+    groups = [
+        (is_fixed_width, tuple(fields))
+        for is_fixed_width, fields in itertools.groupby(
+            headers[key],
+            key=lambda field: field[0] in _FIXED_WIDTH_FORMATS and not field[1],
+        )
+    ]
+
+    # The common case of records with only fixed-width fields can avoid the loop over the steps
+    if len(groups) == 1 and groups[0][0]:
+        run_struct = struct.Struct('>' + ''.join(_FIXED_WIDTH_FORMATS[field_type] for field_type, _, _ in groups[0][1]))
+        unpack_from = run_struct.unpack_from
+        size = run_struct.size
+        sub_keys = tuple(sub_key for _, _, sub_key in groups[0][1])
+        schema = _RecordSchema(sub_keys)
+
+        def decode_fixed_width(buf, pos):
+            return dict(zip(sub_keys, unpack_from(buf, pos))), pos + size
+
+        def decode_fixed_width_compact(buf, pos):
+            return CompactRecord(schema, unpack_from(buf, pos)), pos + size
+
+        return decode_fixed_width_compact if compact else decode_fixed_width
+
+    steps = tuple(
+        decoder
+        for is_fixed_width, fields in groups
+        for decoder in (
+            (fixed_width_run(
+                struct.Struct('>' + ''.join(_FIXED_WIDTH_FORMATS[field_type] for field_type, _, _ in fields)),
+                tuple(sub_key for _, _, sub_key in fields),
+            ),) if is_fixed_width else
+            tuple(field_decoder(*field) for field in fields)
+        )
+    )
+
+    def decode(buf, pos):
+        record = {}
+        for step in steps:
+            pos = step(buf, pos, record)
+        return record, pos
+
+    # The steps set the fields of the record in the order of the header, so the values of the
+    # dict are in the order of the fields of the schema
+    schema = _RecordSchema(tuple(sub_key for _, _, sub_key in headers[key]))
+
+    def decode_compact(buf, pos):
+        record = {}
+        for step in steps:
+            pos = step(buf, pos, record)
+        return CompactRecord(schema, tuple(record.values())), pos
+
+    return decode_compact if compact else decode
+
+
+# Compiled decoders are cached by the bytes of the table header, so all the savegames of the same
+# savegame version, for example all the autosaves of an experiment, share them
+_table_decoders = {}
+
+
+def _table_decoder(header_bytes):
+    try:
+        return _table_decoders[header_bytes]
+    except KeyError:
+        headers = _parse_table_headers(header_bytes)
+        table_decoder = _table_decoders[header_bytes] = (headers, _compile_record_decoder(headers, 'root'))
+        return table_decoder
+
+
+# The NumPy dtypes of the field types that are always encoded in the same number of bytes
+_NUMPY_DTYPES = {
+    FieldType.I8: 'i1',
+    FieldType.U8: 'u1',
+    FieldType.I16: '>i2',
+    FieldType.U16: '>u2',
+    FieldType.I32: '>i4',
+    FieldType.U32: '>u4',
+    FieldType.I64: '>i8',
+    FieldType.U64: '>u8',
+    FieldType.STRINGID: '>u2',
+}
+
+
+def _compile_columns_decoder(headers, key, prefix):
+    """
+    Returns a function that appends the fields of a record of headers[key] from buf at pos to
+    lists in a dict of columns, returning the position after it, and the specification of how to
+    convert these lists into NumPy arrays. Each run of consecutive fixed-width fields is appended
+    as a single slice of bytes, to be converted in one go by NumPy.
+    """
+
+    def fixed_width_run(run_key, size):
+        def decode(buf, pos, columns):
+            columns[run_key].append(buf[pos:pos + size])
+            return pos + size
+
+        return decode
+
+    def string(name):
+        def decode(buf, pos, columns):
+            length, pos = _gamma(buf, pos)
+            columns[name].append(str(buf[pos:pos + length], 'utf-8'))
+            return pos + length
+
+        return decode
+
+    def list_of_fixed_width(name, size):
+        offsets_name = name + '.offsets'
+
+        def decode(buf, pos, columns):
+            length, pos = _gamma(buf, pos)
+            columns[offsets_name].append(length)
+            columns[name].append(buf[pos:pos + length * size])
+            return pos + length * size
+
+        return decode
+
+    def list_of_sub_records(name, decode_sub_record):
+        offsets_name = name + '.offsets'
+
+        def decode(buf, pos, columns):
+            length, pos = _gamma(buf, pos)
+            columns[offsets_name].append(length)
+            for _ in range(length):
+                pos = decode_sub_record(buf, pos, columns)
+            return pos
+
+        return decode
+
+    def field_decoder(field_type, has_length, sub_key):
+        name = prefix + sub_key
+        if field_type == FieldType.STRING:
+            return string(name), (('strings', name),)
+        if field_type == FieldType.STRUCT:
+            decode_sub_record, sub_specs = _compile_columns_decoder(headers, f'{key}.{sub_key}', name + '.')
+            return \
+                (list_of_sub_records(name, decode_sub_record), (('offsets', name + '.offsets'),) + sub_specs) if has_length else \
+                (decode_sub_record, sub_specs)
+        if field_type in _NUMPY_DTYPES:
+            return \
+                list_of_fixed_width(name, struct.calcsize('>' + _FIXED_WIDTH_FORMATS[field_type])), \
+                (('offsets', name + '.offsets'), ('values', name, _NUMPY_DTYPES[field_type]))
+        raise ValidationException(f"Unsupported field type {field_type}.")
+
+    decoders_and_specs = []
+    for i, (is_fixed_width, fields) in enumerate(itertools.groupby(
+        headers[key],
+        key=lambda field: field[0] in _FIXED_WIDTH_FORMATS and not field[1],
+    )):
+        fields = tuple(fields)
+        if is_fixed_width:
+            run_key = (key, i)
+            dtype = tuple((prefix + sub_key, _NUMPY_DTYPES[field_type]) for field_type, _, sub_key in fields)
+            size = struct.calcsize('>' + ''.join(_FIXED_WIDTH_FORMATS[field_type] for field_type, _, _ in fields))
+            decoders_and_specs.append((fixed_width_run(run_key, size), (('run', run_key, dtype),)))
+        else:
+            decoders_and_specs.extend(field_decoder(*field) for field in fields)
+
+    steps = tuple(decoder for decoder, _ in decoders_and_specs)
+    specs = tuple(spec for _, field_specs in decoders_and_specs for spec in field_specs)
+
+    def decode(buf, pos, columns):
+        for step in steps:
+            pos = step(buf, pos, columns)
+        return pos
+
+    return decode, specs
+
+
+def _columns_to_arrays(specs, columns):
+    import numpy as np
+
+    def from_bytes(byte_strings, dtype):
+        values = np.frombuffer(b''.join(byte_strings), dtype=dtype)
+        return values.astype(values.dtype.newbyteorder('='))
+
+    arrays = {}
+    for spec in specs:
+        if spec[0] == 'run':
+            _, run_key, dtype = spec
+            values = np.frombuffer(b''.join(columns[run_key]), dtype=list(dtype))
+            for name, _ in dtype:
+                arrays[name] = values[name].astype(values.dtype[name].newbyteorder('='))
+        elif spec[0] == 'strings':
+            _, name = spec
+            arrays[name] = np.array(columns[name], dtype=object)
+        elif spec[0] == 'offsets':
+            _, name = spec
+            arrays[name] = np.concatenate((np.zeros(1, dtype=np.int64), np.cumsum(np.array(columns[name], dtype=np.int64))))
+        else:
+            _, name, dtype = spec
+            arrays[name] = from_bytes(columns[name], dtype)
+
+    return arrays
+
+
+_table_columns_decoders = {}
+
+
+def _table_columns_decoder(tag, header_bytes):
+    try:
+        headers, decode_record_columns, specs = _table_columns_decoders[header_bytes]
+    except KeyError:
+        headers, _ = _table_decoder(header_bytes)
+        decode_record_columns, specs = _compile_columns_decoder(headers, 'root', '')
+        _table_columns_decoders[header_bytes] = (headers, decode_record_columns, specs)
+
+    # Each chunk has its own lists that the records of the chunk are appended to. The "record"
+    # returned for each is the same function that converts all these lists into NumPy arrays
+    columns = defaultdict(list)
+
+    def to_arrays():
+        return _columns_to_arrays(specs, columns)
+
+    def decode_record(buf, pos):
+        return to_arrays, decode_record_columns(buf, pos, columns)
+
+    return (_copy_headers(headers), to_arrays), decode_record
+
+
+def _copy_headers(headers):
+    return {
+        key: list(fields)
+        for key, fields in headers.items()
+    }
+
+
+def _table_records_decoder(tag, header_bytes):
+    headers, decode_record = _table_decoder(header_bytes)
+    return _copy_headers(headers), decode_record
+
+
+_table_compact_decoders = {}
+
+
+def _table_compact_records_decoder(tag, header_bytes):
+    try:
+        headers, decode_record = _table_compact_decoders[header_bytes]
+    except KeyError:
+        headers, _ = _table_decoder(header_bytes)
+        headers, decode_record = _table_compact_decoders[header_bytes] = (headers, _compile_record_decoder(headers, 'root', compact=True))
+    return _copy_headers(headers), decode_record
+
+
+# The tiles of the map are stored in RIFF chunks, one for each of the fields of a tile, in
+# big-endian order of tiles from the north corner of the map along the x axis
+_MAP_DTYPES = {
+    'MAPT': 'u1',
+    'MAPH': 'u1',
+    'MAPO': 'u1',
+    'MAP2': '>u2',
+    'M3LO': 'u1',
+    'M3HI': 'u1',
+    'MAP5': 'u1',
+    'MAPE': 'u1',
+    'MAP7': 'u1',
+    'MAP8': '>u2',
+}
+
+
+def _compile_record_skipper(headers, key):
+    """
+    Returns a function that skips over a record of the fields of headers[key] in buf at pos,
+    returning the position after it, without decoding any values other than lengths.
+    """
+
+    def fixed_width(size):
+        def skip(buf, pos):
+            return pos + size
+
+        return skip
+
+    def string_or_list_of_fixed_width(size):
+        def skip(buf, pos):
+            length, pos = _gamma(buf, pos)
+            return pos + length * size
+
+        return skip
+
+    def list_of_sub_records(skip_sub_record):
+        def skip(buf, pos):
+            length, pos = _gamma(buf, pos)
+            for _ in range(length):
+                pos = skip_sub_record(buf, pos)
+            return pos
+
+        return skip
+
+    def field_skipper(field_type, has_length, sub_key):
+        return \
+            string_or_list_of_fixed_width(1) if field_type == FieldType.STRING else \
+            list_of_sub_records(_compile_record_skipper(headers, f'{key}.{sub_key}')) if field_type == FieldType.STRUCT and has_length else \
+            _compile_record_skipper(headers, f'{key}.{sub_key}') if field_type == FieldType.STRUCT else \
+            string_or_list_of_fixed_width(struct.calcsize('>' + _FIXED_WIDTH_FORMATS[field_type])) if has_length else \
+            fixed_width(struct.calcsize('>' + _FIXED_WIDTH_FORMATS[field_type]))
+
+    # Runs of fixed-width fields are skipped in one go
+    steps = tuple(
+        step
+        for is_fixed_width, fields in itertools.groupby(
+            headers[key],
+            key=lambda field: field[0] in _FIXED_WIDTH_FORMATS and not field[1],
+        )
+        for step in (
+            (fixed_width(struct.calcsize('>' + ''.join(_FIXED_WIDTH_FORMATS[field_type] for field_type, _, _ in fields))),) if is_fixed_width else
+            tuple(field_skipper(*field) for field in fields)
+        )
+    )
+
+    if len(steps) == 1:
+        return steps[0]
+
+    def skip(buf, pos):
+        for step in steps:
+            pos = step(buf, pos)
+        return pos
+
+    return skip
+
+
+def _compile_field_decoder(headers, key, field):
+    # A field is decoded by the decoder of a record with only that field
+    decode_record = _compile_record_decoder({**headers, key: [field]}, key)
+    sub_key = field[2]
+
+    def decode(buf, pos):
+        record, pos = decode_record(buf, pos)
+        return record[sub_key], pos
+
+    return decode
+
+
+def _select_path(value, path):
+    # Selects the value at the path from an already decoded record or list of records. Keys can
+    # contain dots, so each key is tested to see if it's a prefix of the path
+    if isinstance(value, list):
+        return [_select_path(item, path) for item in value]
+
+    # A key that is the entire path wins over a key that is a prefix of it, whatever their order
+    if path in value:
+        return value[path]
+
+    for key, sub_value in value.items():
+        if path == key:
+            return sub_value
+        if path.startswith(key + '.') and isinstance(sub_value, (dict, list)):
+            return _select_path(sub_value, path[len(key) + 1:])
+
+    raise KeyError(path)
+
+
+def _compile_selective_decoder(headers, key, paths):
+    """
+    Returns a function that decodes only the fields of a record of headers[key] in buf at pos
+    that are selected by paths, skipping the bytes of all the others. It returns a dict of each
+    path that exists in the headers to its value, and the position after the record. A path into
+    a list of sub-records has the list of values from each of them.
+    """
+
+    def fixed_width_run(fields):
+        # Unselected fields in the run are pad bytes in the Struct, and so skipped by unpack_from
+        run_struct = struct.Struct('>' + ''.join(
+            _FIXED_WIDTH_FORMATS[field_type] if sub_key in paths else
+            f'{struct.calcsize(">" + _FIXED_WIDTH_FORMATS[field_type])}x'
+            for field_type, _, sub_key in fields
+        ))
+        unpack_from = run_struct.unpack_from
+        size = run_struct.size
+        sub_keys = tuple(sub_key for _, _, sub_key in fields if sub_key in paths)
+
+        def decode(buf, pos, selected):
+            selected.update(zip(sub_keys, unpack_from(buf, pos)))
+            return pos + size
+
+        def skip(buf, pos, selected):
+            return pos + size
+
+        return decode if sub_keys else skip
+
+    def whole_field(field, nested_paths):
+        decode_field = _compile_field_decoder(headers, key, field)
+        sub_key = field[2]
+
+        def decode(buf, pos, selected):
+            value, pos = decode_field(buf, pos)
+            selected[sub_key] = value
+            for nested_path in nested_paths:
+                try:
+                    selected[f'{sub_key}.{nested_path}'] = _select_path(value, nested_path)
+                except KeyError:
+                    pass
+            return pos
+
+        return decode
+
+    def nested_fields(field, nested_paths):
+        field_type, has_length, sub_key = field
+        decode_sub_record = _compile_selective_decoder(headers, f'{key}.{sub_key}', nested_paths)
+
+        def decode_list(buf, pos, selected):
+            length, pos = _gamma(buf, pos)
+            sub_records = []
+            for _ in range(length):
+                sub_selected, pos = decode_sub_record(buf, pos)
+                sub_records.append(sub_selected)
+            for nested_path in nested_paths:
+                if all(nested_path in sub_selected for sub_selected in sub_records):
+                    selected[f'{sub_key}.{nested_path}'] = [sub_selected[nested_path] for sub_selected in sub_records]
+            return pos
+
+        def decode_single(buf, pos, selected):
+            sub_selected, pos = decode_sub_record(buf, pos)
+            for nested_path, value in sub_selected.items():
+                selected[f'{sub_key}.{nested_path}'] = value
+            return pos
+
+        return decode_list if has_length else decode_single
+
+    def skipped_field(field):
+        skip_field = _compile_record_skipper({**headers, key: [field]}, key)
+
+        def skip(buf, pos, selected):
+            return skip_field(buf, pos)
+
+        return skip
+
+    # A field whose name contains dots is selected by its name rather than by a path into a struct
+    # whose name is a prefix of it, for example cargo.reserved_count rather than the cargo list
+    field_names = frozenset(sub_key for _, _, sub_key in headers[key])
+
+    def field_step(field):
+        field_type, has_length, sub_key = field
+        nested_paths = frozenset(
+            path[len(sub_key) + 1:]
+            for path in paths
+            if path.startswith(sub_key + '.') and path not in field_names
+        ) if field_type == FieldType.STRUCT else frozenset()
+        return \
+            whole_field(field, nested_paths) if sub_key in paths else \
+            nested_fields(field, nested_paths) if nested_paths else \
+            skipped_field(field)
+
+    steps = tuple(
+        step
+        for is_fixed_width, fields in itertools.groupby(
+            headers[key],
+            key=lambda field: field[0] in _FIXED_WIDTH_FORMATS and not field[1],
+        )
+        for step in (
+            (fixed_width_run(tuple(fields)),) if is_fixed_width else
+            tuple(field_step(field) for field in fields)
+        )
+    )
+
+    def decode(buf, pos):
+        selected = {}
+        for step in steps:
+            pos = step(buf, pos, selected)
+        return selected, pos
+
+    return decode
+
+
+_table_selective_decoders = {}
+
+
+def _table_selective_decoder(header_bytes, paths):
+    try:
+        return _table_selective_decoders[(header_bytes, paths)]
+    except KeyError:
+        headers, decode_record = _table_decoder(header_bytes)
+
+        # The empty path selects the entire record, from which any other path can be selected
+        if '' in paths:
+            def decode_selected(buf, pos):
+                record, pos = decode_record(buf, pos)
+                selected = {'': record}
+                for path in paths:
+                    try:
+                        selected[path] = _select_path(record, path) if path else record
+                    except KeyError:
+                        pass
+                return selected, pos
+        else:
+            decode_selected = _compile_selective_decoder(headers, 'root', paths)
+
+        table_selective_decoder = _table_selective_decoders[(header_bytes, paths)] = (headers, decode_selected)
+        return table_selective_decoder
+
+
+def _decode_record_bytes(decode_record, tag, record_bytes, pos):
+    try:
+        record, end_pos = decode_record(record_bytes, pos)
+    except (IndexError, struct.error):
+        raise ValidationException(f"Record too short in chunk {tag}")
+
+    if end_pos > len(record_bytes):
+        raise ValidationException(f"Record too short in chunk {tag}")
+
+    # GSDT and AIPL are known chunk with garbage at the end
+    if tag not in ("GSDT", "AIPL") and end_pos != len(record_bytes):
+        raise ValidationException(f"Junk at end of chunk {tag}")
+
+    return record
+
+
+def _iter_savegame(chunks, chunk_size, chunk_tags, table_decoder=_table_records_decoder, toc=None, record_indexes=None, index=False, index_records=True, pipelined=False, stats_callback=None, map_arrays=False):
 
     def get_readers(iterable):
         chunk = b''
@@ -800,12 +1874,77 @@ def parse_savegame(chunks, chunk_size=65536):
                 pass
 
         def _read(num):
+            nonlocal chunk_offset, offset
+
+            # Avoid the overhead of joining when the bytes are all in the current chunk
+            end = chunk_offset + num
+            if end <= len(chunk):
+                chunk_offset = end
+                offset += num
+                return chunk[end - num:end]
+
             return b''.join(_num_iter(num))
 
-        def _offset():
+        def _skip(num):
+            nonlocal chunk, chunk_offset, offset
+
+            if num < 0:
+                raise ValidationException("Cannot seek backwards in a stream.")
+
+            # Advances without slicing or joining any of the skipped bytes
+            while num:
+                if chunk_offset == len(chunk):
+                    try:
+                        chunk = next(it)
+                    except StopIteration:
+                        raise ValidationException("Unexpected end-of-file.")
+                    chunk_offset = 0
+                to_skip = min(num, len(chunk) - chunk_offset)
+                num -= to_skip
+                chunk_offset += to_skip
+                offset += to_skip
+
+        def _tell():
+            return offset
+
+        return _read, _read_iter, _skip, _tell
+
+    def get_buffer_readers(buf):
+        # Reads from a single buffer, for example of an entire decompressed savegame, by slicing
+        # memoryviews that do not copy the underlying bytes
+        buf = memoryview(buf).cast('B')
+        offset = 0
+
+        def _read_iter():
+            nonlocal offset
+            while offset < len(buf):
+                start = offset
+                offset = min(offset + chunk_size, len(buf))
+                yield buf[start:offset]
+
+        def _read(num):
+            nonlocal offset
+            if offset + num > len(buf):
+                raise ValidationException("Unexpected end-of-file.")
+            offset += num
+            return buf[offset - num:offset]
+
+        def _skip(num):
+            nonlocal offset
+            if not 0 <= offset + num <= len(buf):
+                raise ValidationException("Unexpected end-of-file.")
+            offset += num
+
+        def _tell():
             return offset
 
-        return _read, _read_iter, _offset
+        return _read, _read_iter, _skip, _tell
+
+    def decompress_into_buffer(decompressed_chunks):
+        buf = bytearray()
+        for chunk in decompressed_chunks:
+            buf += chunk
+        return buf
 
     def decompress_zlib(compressed_chunks):
         dobj = zlib.decompressobj()
@@ -828,6 +1967,50 @@ def parse_savegame(chunks, chunk_size=65536):
     def decompress_none(compressed_chunks):
         yield from compressed_chunks
 
+    def decompress_in_thread(decompressed_chunks, stack):
+        # zlib and lzma release the GIL while decompressing, so decompressing in a thread ahead of
+        # decoding overlaps the two. The number of decompressed chunks waiting to be decoded is
+        # bounded, so memory use doesn't depend on the size of the savegame
+        ring = queue.Queue(maxsize=16)
+        stopped = threading.Event()
+
+        def produce():
+            try:
+                for chunk in decompressed_chunks:
+                    if stopped.is_set():
+                        return
+                    ring.put((True, chunk))
+            except BaseException as e:
+                ring.put((False, e))
+            else:
+                ring.put((False, None))
+
+        def consume():
+            while True:
+                is_chunk, chunk_or_exception = ring.get()
+                if is_chunk:
+                    yield chunk_or_exception
+                elif chunk_or_exception is None:
+                    return
+                else:
+                    raise chunk_or_exception
+
+        def stop():
+            # Once stopped the producer puts at most one more chunk, so emptying the ring means
+            # it can't block forever
+            stopped.set()
+            while thread.is_alive():
+                try:
+                    ring.get(timeout=0.01)
+                except queue.Empty:
+                    pass
+            thread.join()
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+        stack.callback(stop)
+        return consume()
+
     decompressors = {
         b"OTTN": decompress_none,
         b"OTTZ": decompress_zlib,
@@ -839,23 +2022,6 @@ def parse_savegame(chunks, chunk_size=65536):
         # b"OTTD": lzo2,
     }
 
-    class FieldType(enum.IntEnum):
-        END = 0
-        I8 = 1
-        U8 = 2
-        I16 = 3
-        U16 = 4
-        I32 = 5
-        U32 = 6
-        I64 = 7
-        U64 = 8
-        STRINGID = 9
-        STRING = 10
-        STRUCT = 11
-
-    def _raise(e):
-        raise e
-
     def gamma(read):
         """
         Read OTTD-savegame-style gamma value.
@@ -869,20 +2035,8 @@ def parse_savegame(chunks, chunk_size=65536):
             (b & 0x07) << 32 | uint32(read) if (b & 0xF8) == 0xF0 else \
             _raise(ValidationException("Invalid gamma encoding."))
 
-    def gamma_str(read):
-        """
-        Read OTTD-savegame-style gamma string (SLE_STR).
-        """
-        return read(gamma(read)).decode()
-
-    def int8(read):
-        return struct.unpack(">b", read(1))[0]
-
     def uint8(read):
-        return struct.unpack(">B", read(1))[0]
-
-    def int16(read):
-        return struct.unpack(">h", read(2))[0]
+        return read(1)[0]
 
     def uint16(read):
         return struct.unpack(">H", read(2))[0]
@@ -890,187 +2044,1492 @@ def parse_savegame(chunks, chunk_size=65536):
     def uint24(read):
         return (uint16(read) << 8) | uint8(read)
 
-    def int32(read):
-        return struct.unpack(">l", read(4))[0]
-
     def uint32(read):
         return struct.unpack(">L", read(4))[0]
 
-    def int64(read):
-        return struct.unpack(">q", read(8))[0]
-
-    def uint64(read):
-        return struct.unpack(">Q", read(8))[0]
-
-    readers = {
-        FieldType.I8: int8,
-        FieldType.U8: uint8,
-        FieldType.I16: int16,
-        FieldType.U16: uint16,
-        FieldType.I32: int32,
-        FieldType.U32: uint32,
-        FieldType.I64: int64,
-        FieldType.U64: uint64,
-        FieldType.STRINGID: uint16,
-        FieldType.STRING: gamma_str,
-    }
+    def read_table_records(read, skip, decode_record, tag, chunk_type, record_offsets):
+        # If the offsets of records are known from a table of contents, only those records are read
+        counter = \
+            iter(itertools.count()) if record_offsets is None else \
+            iter(int(record_index) for record_index, _ in record_offsets)
+        decoding = True
+
+        def record_sizes():
+            if record_offsets is None:
+                while size_plus_one := gamma(read):
+                    yield size_plus_one
+            else:
+                for _, record_offset in record_offsets:
+                    seek(record_offset)
+                    yield gamma(read)
+
+        def _records():
+            for size_plus_one in record_sizes():
+                if not decoding:
+                    skip(size_plus_one - 1)
+                    continue
+
+                record_bytes = read(size_plus_one - 1)
+                index, pos = \
+                    _gamma(record_bytes, 0) if chunk_type == 4 else \
+                    (next(counter), 0)
+
+                if pos == len(record_bytes):
+                    continue
+
+                yield str(index), _decode_record_bytes(decode_record, tag, record_bytes, pos)
+
+        def _skip_remaining():
+            nonlocal decoding
+            decoding = False
+            for _ in records:
+                pass
 
-    def read_table_headers(read):
-        """Reads the headers for a chunk."""
+        records = _records()
+        return records, _skip_remaining
 
-        def read_fields():
-            while type := int8(read):
-                yield (
-                    FieldType(type & 0xf),  # Field type
-                    bool(type & 0x10),      # Has length
-                    gamma_str(read),        # Key
-                )
+    def skip_chunk_records(read, skip, chunk_type):
+        # Table chunks have a header, which like each record is prefixed by its size plus one
+        if chunk_type in (3, 4):
+            skip(gamma(read) - 1)
+        while size_plus_one := gamma(read):
+            skip(size_plus_one - 1)
 
-        def read_substruct(header, parent_key):
-            for field_type, has_length, sub_key in header:
-                if field_type == FieldType.STRUCT:
-                    sub_header = list(read_fields())
-                    full_sub_key = f'{parent_key}.{sub_key}'
-                    yield full_sub_key, sub_header
-                    yield from read_substruct(sub_header, full_sub_key)
+    def read_chunks(read, skip):
+        map_dims = None
 
-        root_header = list(read_fields())
-        sub_headers = list(read_substruct(root_header, "root"))
-        return {
-            "root": root_header,
-            **dict(sub_headers),
-        }
+        def read_riff_chunk(tag):
+            size = (m >> 4) << 24 | uint24(read)
+            if not map_arrays or tag not in _MAP_DTYPES:
+                skip(size)
+                return {"unsupported": ""}, (), lambda: None
+
+            # The tiles of the map are a view of the decompressed bytes, without copying if possible
+            import numpy as np
+            if map_dims is None:
+                raise ValidationException(f"Chunk {tag} before MAPS chunk.")
+            dim_x, dim_y = map_dims
+            dtype = np.dtype(_MAP_DTYPES[tag])
+            if size != dim_x * dim_y * dtype.itemsize:
+                raise ValidationException(f"Unexpected size of chunk {tag}.")
+            tiles = np.frombuffer(read(size), dtype=dtype).reshape(dim_y, dim_x)
+            return {"unsupported": ""}, (('0', tiles),), lambda: None
 
-    def read_table_record(read, headers):
-        """Reads a record for a chunk."""
+        def read_array_chunk():
+            while size_plus_one := gamma(read):
+                skip(size_plus_one - 1)
+            headers = {"unsupported": ""}
+            records = ()
+            return headers, records, lambda: None
 
-        def read_using_header_key(key):
-            return {
-                sub_key: \
-                    read_list_of_fields(field_type, f'{key}.{sub_key}') if has_length and field_type != FieldType.STRING else \
-                    read_field(field_type, f'{key}.{sub_key}')
-                for field_type, has_length, sub_key in headers[key]
+        def skip_chunk(chunk_type):
+            if chunk_type == 0:
+                skip((m >> 4) << 24 | uint24(read))
+                return
+
+            skip_chunk_records(read, skip, chunk_type)
+
+        def read_table_chunk(tag, chunk_type):
+            header_bytes = bytes(read(gamma(read) - 1))
+            headers, decode_record = table_decoder(tag, header_bytes)
+
+            # The dimensions of the map are needed for the tiles of the MAP* chunks that follow
+            if map_arrays and tag == 'MAPS':
+                _, decode_map_size = _table_decoder(header_bytes)
+                decode_record_only = decode_record
+
+                def decode_record(buf, pos):
+                    nonlocal map_dims
+                    map_size, _ = decode_map_size(buf, pos)
+                    map_dims = (map_size['dim_x'], map_size['dim_y'])
+                    return decode_record_only(buf, pos)
+
+            record_offsets = \
+                None if record_indexes is None else \
+                sorted((
+                    (record_index, toc['chunks'][tag]['record_offsets'][record_index])
+                    for record_index in record_indexes
+                    if record_index in toc['chunks'][tag]['record_offsets']
+                ), key=lambda index_and_offset: index_and_offset[1])
+            return (headers,) + read_table_records(read, skip, decode_record, tag, chunk_type, record_offsets)
+
+        def read_tags():
+            if toc is None:
+                while (tag_bytes := read(4)) != b"\0\0\0\0":
+                    yield bytes(tag_bytes).decode()
+                check_tail()
+                return
+
+            # Chunks are read in the order they are in the savegame, so streams are only read forwards
+            for tag, entry in sorted(toc['chunks'].items(), key=lambda tag_and_entry: tag_and_entry[1]['offset']):
+                if chunk_tags is not None and tag not in chunk_tags and not (map_arrays and tag == 'MAPS'):
+                    continue
+                seek(entry['offset'])
+                if bytes(read(4)).decode() != tag:
+                    raise ValidationException("Savegame does not match its table of contents.")
+                yield tag
+
+        for tag in read_tags():
+            m = uint8(read)
+            chunk_type = m & 0xF
+
+            if chunk_type not in (0, 1, 2, 3, 4):
+                raise ValidationException("Unknown chunk type.")
+
+            if map_arrays and tag == 'MAPS' and chunk_tags is not None and tag not in chunk_tags:
+                _, records, _ = read_table_chunk(tag, chunk_type)
+                for _ in records:
+                    pass
+                continue
+
+            if chunk_tags is not None and tag not in chunk_tags:
+                skip_chunk(chunk_type)
+                continue
+
+            if stats_callback is not None:
+                start_offset = tell() - 5
+                start_compressed_bytes = counters['compressed_bytes']
+                start_decompress_seconds = counters['decompress_seconds']
+                start_seconds = time.perf_counter()
+
+            headers, records, skip_remaining = \
+                read_riff_chunk(tag) if chunk_type == 0 else \
+                read_array_chunk() if chunk_type in (1, 2) else \
+                read_table_chunk(tag, chunk_type)
+
+            if stats_callback is not None:
+                num_records = 0
+
+                def counted(records):
+                    nonlocal num_records
+                    for record in records:
+                        num_records += 1
+                        yield record
+
+                records = counted(records)
+
+            yield tag, headers, records
+
+            # Records are decoded lazily, and so any that the client did not iterate over must be
+            # skipped to get to the next chunk
+            skip_remaining()
+
+            if stats_callback is not None:
+                seconds = time.perf_counter() - start_seconds
+                decompress_seconds = counters['decompress_seconds'] - start_decompress_seconds
+                decompressed_bytes = tell() - start_offset
+                stats_callback(tag, {
+                    'compressed_bytes': \
+                        decompressed_bytes if compression == b"OTTN" else \
+                        counters['compressed_bytes'] - start_compressed_bytes,
+                    'decompressed_bytes': decompressed_bytes,
+                    'num_records': num_records,
+                    'seconds': seconds,
+                    'decompress_seconds': decompress_seconds,
+                    'decode_seconds': seconds - decompress_seconds,
+                })
+
+    def index_chunks(read, skip):
+        # Finds the offset, size, and number of records of each chunk, and the offset of each
+        # record of table chunks, by only reading sizes and the indexes of sparse records. If not
+        # index_records, only the offset and size of each chunk is found, skipping every record
+        # by its size without reading the indexes of sparse records
+        while True:
+            offset = tell()
+            if (tag_bytes := read(4)) == b"\0\0\0\0":
+                break
+            tag = bytes(tag_bytes).decode()
+
+            m = uint8(read)
+            chunk_type = m & 0xF
+
+            if chunk_type not in (0, 1, 2, 3, 4):
+                raise ValidationException("Unknown chunk type.")
+
+            num_records = 0
+            record_offsets = {}
+            if chunk_type == 0:
+                skip((m >> 4) << 24 | uint24(read))
+            elif not index_records:
+                skip_chunk_records(read, skip, chunk_type)
+            else:
+                if chunk_type in (3, 4):
+                    skip(gamma(read) - 1)
+                counter = iter(itertools.count())
+                while True:
+                    record_offset = tell()
+                    if not (size_plus_one := gamma(read)):
+                        break
+                    if chunk_type in (2, 4):
+                        record_index, pos = _gamma(read(size_plus_one - 1), 0)
+                        is_empty = pos == size_plus_one - 1
+                    else:
+                        skip(size_plus_one - 1)
+                        record_index = next(counter)
+                        is_empty = size_plus_one == 1
+                    if is_empty:
+                        continue
+                    num_records += 1
+                    if chunk_type in (3, 4):
+                        record_offsets[str(record_index)] = record_offset
+
+            yield tag, {
+                'chunk_type': chunk_type,
+                'offset': offset,
+                'size': tell() - offset,
+                **({
+                    'num_records': num_records,
+                    **({'record_offsets': record_offsets} if chunk_type in (3, 4) else {}),
+                } if index_records else {}),
             }
 
-        def read_list_of_fields(field_type, field_name):
-            length = gamma(read)
-            return [
-                read_field(field_type, field_name)
-                for _ in range(length)
-            ]
+        check_tail()
 
-        def read_field(field_type, field_name):
-            return \
-                read_using_header_key(field_name) if field_type == FieldType.STRUCT else \
-                readers[field_type](read)
+    def check_tail():
+        try:
+            uint8(inner_read)
+        except ValidationException:
+            pass
+        else:
+            raise ValidationException(f"Junk at the end of file.")
 
-        return read_using_header_key("root")
+    def seek(offset):
+        inner_skip(offset - tell())
 
-    def read_table_records(read, offset, headers, tag, chunk_type):
-        counter = iter(itertools.count())
+    # For statistics, the compressed bytes read and the time spent decompressing so far
+    counters = {'compressed_bytes': 0, 'decompress_seconds': 0.0}
 
-        while size_plus_one := gamma(read):
+    def count_compressed_bytes(compressed_chunks):
+        # Compressed data is passed to the decompressor in small pieces, so the bytes counted
+        # when each chunk is read are roughly the compressed bytes of that chunk
+        for compressed_chunk in compressed_chunks:
+            for i in range(0, len(compressed_chunk), 1024):
+                counters['compressed_bytes'] += len(compressed_chunk[i:i + 1024])
+                yield compressed_chunk[i:i + 1024]
+
+    def time_decompression(decompressed_chunks):
+        decompressed_chunks = iter(decompressed_chunks)
+        while True:
+            start = time.perf_counter()
+            try:
+                decompressed_chunk = next(decompressed_chunks)
+            except StopIteration:
+                return
+            finally:
+                counters['decompress_seconds'] += time.perf_counter() - start
+            yield decompressed_chunk
+
+    chunk_tags = None if chunk_tags is None else frozenset(chunk_tags)
+
+    with contextlib.ExitStack() as stack:
+        # A path is read as a single buffer: memory mapped if uncompressed, or decompressed into one
+        # buffer otherwise. Bytes-like objects are also read as a single buffer, but any other
+        # iterable of bytes is streamed, using memory independent of the size of the savegame
+        is_path = isinstance(chunks, (str, os.PathLike))
+        is_buffer = isinstance(chunks, (bytes, bytearray, memoryview, mmap.mmap))
+        if is_path:
+            f = stack.enter_context(open(chunks, 'rb'))
+            is_outer_buffer = f.read(4) == b'OTTN'
+            f.seek(0)
+            outer_buffer = stack.enter_context(_mmap_file(f)) if is_outer_buffer else None
+            outer_read, outer_read_iter, outer_skip, outer_tell = \
+                get_buffer_readers(outer_buffer) if is_outer_buffer else \
+                get_readers(iter(lambda: f.read(chunk_size), b''))
+        else:
+            is_outer_buffer = is_buffer
+            outer_buffer = chunks if is_buffer else None
+            outer_read, outer_read_iter, outer_skip, outer_tell = \
+                get_buffer_readers(chunks) if is_buffer else \
+                get_readers(chunks)
 
-            start_offset = offset()
-            index = \
-                gamma(read) if chunk_type == 4 else \
-                next(counter)
-            end_offset = offset()
+        compression = outer_read(4)
+        savegame_version = uint16(outer_read)
+        uint16(outer_read)
 
-            size = size_plus_one - 1 - (end_offset - start_offset)
+        try:
+            decompressor = decompressors[compression]
+        except KeyError:
+            raise ValidationException(f"Unknown savegame compression {compression}.")
+
+        # With a table of contents only the start of a compressed savegame up to the last chunk
+        # needed is decompressed, so it's streamed rather than decompressed into a buffer. If
+        # pipelined, it's also streamed so decoding can start before decompression finishes, and
+        # for statistics so decompression can be attributed to each chunk
+        is_inner_outer = is_outer_buffer and compression == b"OTTN"
+        is_pipelined = pipelined and compression != b"OTTN"
+        decompressed_chunks = \
+            decompressor(outer_read_iter()) if stats_callback is None else \
+            time_decompression(decompressor(count_compressed_bytes(outer_read_iter())))
+        inner_read, _, inner_skip, inner_tell = \
+            (outer_read, outer_read_iter, outer_skip, outer_tell) if is_inner_outer else \
+            get_readers(decompress_in_thread(decompressed_chunks, stack)) if is_pipelined else \
+            get_buffer_readers(decompress_into_buffer(decompressed_chunks)) if (is_path or is_buffer) and toc is None and stats_callback is None else \
+            get_readers(decompressed_chunks)
+
+        # Offsets are relative to the start of the decompressed data, after the 8 byte header
+        tell = \
+            (lambda: inner_tell() - 8) if is_inner_outer else \
+            inner_tell
+
+        # The offsets of a table of contents are in the decompressed data, so it can be used with
+        # the savegame compressed differently. The size of the decompressed data is only checked if
+        # it's known without decompressing, but the tag of each chunk read is checked at its offset
+        decompressed_size = len(outer_buffer) - 8 if is_inner_outer else None
+        if toc is not None and (
+            toc['savegame_version'] != savegame_version or
+            decompressed_size is not None and toc.get('decompressed_size', decompressed_size) != decompressed_size
+        ):
+            raise ValidationException("Savegame does not match its table of contents.")
+
+        savegame_chunks = \
+            index_chunks(inner_read, inner_skip) if index else \
+            read_chunks(inner_read, inner_skip)
+        close = stack.pop_all().close
+
+    def close_savegame():
+        # The generator must be closed first to release its views of any memory mapped file
+        savegame_chunks.close()
+        close()
+
+    return savegame_version, savegame_chunks, close_savegame
 
-            if size == 0:
-                continue
 
-            start_offset = offset()
-            record = read_table_record(read, headers)
-            end_offset = offset()
+@contextlib.contextmanager
+def _mmap_file(f):
+    # mmap can't map empty files, but an empty buffer results in the same "Unexpected end-of-file"
+    # error as any other empty savegame
+    if os.fstat(f.fileno()).st_size == 0:
+        yield b''
+        return
+
+    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        yield mapped
+    finally:
+        try:
+            mapped.close()
+        except BufferError:
+            # Views of the mapped file are still referenced, for example by NumPy arrays. It is
+            # closed when they are garbage collected
+            pass
 
-            # GSDT and AIPL are known chunk with garbage at the end
-            if tag not in ("GSDT", "AIPL") and size != (end_offset - start_offset):
-                raise ValidationException(f"Junk at end of chunk {tag}")
 
-            read(size - (end_offset - start_offset))
+def inspect_savegame(chunks, chunk_size=65536, sidecar=False):
+    # The sidecar file is only used if the savegame has not changed since it was written
+    if sidecar:
+        sidecar_path = f'{os.fspath(chunks)}.toc.json'
+        source_stat = os.stat(chunks)
+        source = {'size': source_stat.st_size, 'mtime_ns': source_stat.st_mtime_ns}
+        try:
+            with open(sidecar_path, 'r', encoding='utf-8') as f:
+                toc = json.load(f)
+        except (OSError, ValueError):
+            pass
+        else:
+            if toc.pop('source', None) == source:
+                return toc
 
-            yield str(index), record
+    # An iterable of bytes is read in full, as when parsing in parallel, so its compression can be
+    # found from its start
+    if not isinstance(chunks, (str, os.PathLike, bytes, bytearray, memoryview, mmap.mmap)):
+        chunks = b''.join(chunks)
 
-    def read_chunks(read, offset):
+    if isinstance(chunks, (str, os.PathLike)):
+        with open(chunks, 'rb') as f:
+            compression = f.read(4)
+    else:
+        compression = bytes(memoryview(chunks)[:4])
 
-        def read_riff_chunk():
-            size = (m >> 4) << 24 | uint24(read)
-            read(size)
-            headers = {"unsupported": ""}
-            records = ()
-            return headers, records
+    savegame_version, savegame_chunks, close = _iter_savegame(chunks, chunk_size=chunk_size, chunk_tags=None, index=True)
+    try:
+        toc = {
+            'savegame_version': savegame_version,
+            'compression': compression.decode(),
+            'chunks': dict(savegame_chunks),
+        }
+    finally:
+        close()
+    # The chunks are followed by 4 zero bytes that end the savegame
+    toc['decompressed_size'] = max((entry['offset'] + entry['size'] for entry in toc['chunks'].values()), default=0) + 4
 
-        def read_array_chunk():
-            while size_plus_one := gamma(read):
-                read(size_plus_one - 1)
-            headers = {"unsupported": ""}
-            records = ()
-            return headers, records
+    if sidecar:
+        # Written to a temporary file first so concurrent readers never see a partial file
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=os.path.dirname(sidecar_path) or '.', delete=False) as f:
+            json.dump({**toc, 'source': source}, f)
+        os.replace(f.name, sidecar_path)
 
-        def read_table_chunk(tag, chunk_type):
-            size = gamma(read) - 1
+    return toc
+
+
+def parse_savegame_records(chunks, toc, tag, record_indexes, chunk_size=65536):
+    savegame_version, savegame_chunks, close = _iter_savegame(
+        chunks, chunk_size=chunk_size, chunk_tags=(tag,), toc=toc, record_indexes=tuple(record_indexes),
+    )
+    try:
+        return {
+            record_index: record
+            for _, _, records in savegame_chunks
+            for record_index, record in records
+        }
+    finally:
+        close()
 
-            start_offset = offset()
-            headers = read_table_headers(read)
-            end_offset = offset()
 
-            if size != (end_offset - start_offset):
-                raise ValidationException("Table header size mismatch.")
+@contextlib.contextmanager
+def iter_savegame(chunks, chunk_size=65536, chunk_tags=None, toc=None, pipelined=False, stats_callback=None, map_arrays=False):
+    savegame_version, savegame_chunks, close = _iter_savegame(
+        chunks, chunk_size=chunk_size, chunk_tags=chunk_tags, toc=toc, pipelined=pipelined, stats_callback=stats_callback,
+        map_arrays=map_arrays,
+    )
+    try:
+        yield savegame_version, savegame_chunks
+    finally:
+        close()
+
+
+def parse_savegame(
+    chunks,
+    chunk_size=65536,
+    chunk_tags=None,
+    output='records',
+    toc=None,
+    pipelined=False,
+    stats_callback=None,
+    max_workers=1,
+    map_arrays=False,
+    compact_records=False,
+    parse_cache=False,
+    parse_cache_max_bytes=1000000000,
+    lazy=False,
+    get_cache_dir=lambda: _user_cache_dir(),
+):
+    if lazy:
+        if output != 'records' or pipelined or max_workers > 1 or map_arrays or parse_cache:
+            raise ValueError('lazy can only be used with records output, and without pipelined, max_workers, map_arrays or parse_cache')
+        return _parse_savegame_lazy(chunks, chunk_size, chunk_tags, toc, stats_callback, compact_records)
+
+    if parse_cache:
+        return _parse_savegame_cached(
+            chunks, chunk_size, chunk_tags, output, toc, pipelined, stats_callback, max_workers, map_arrays,
+            compact_records, parse_cache_max_bytes, get_cache_dir,
+        )
 
-            return headers, read_table_records(read, offset, headers, tag, chunk_type)
+    if max_workers > 1:
+        if stats_callback is not None:
+            raise ValueError('stats_callback is not supported with more than one worker')
+        return _parse_savegame_parallel(
+            chunks, chunk_size=chunk_size, chunk_tags=chunk_tags, output=output, toc=toc, max_workers=max_workers, map_arrays=map_arrays,
+            compact_records=compact_records,
+        )
 
-        while (tag_bytes := read(4)) != b"\0\0\0\0":
-            tag = tag_bytes.decode()
+    if output == 'columns':
+        return _parse_savegame_columns(
+            chunks, chunk_size=chunk_size, chunk_tags=chunk_tags, toc=toc, pipelined=pipelined, stats_callback=stats_callback,
+            map_arrays=map_arrays,
+        )
+    if output != 'records':
+        raise ValueError(f"Unknown output {output}")
 
-            m = uint8(read)
-            chunk_type = m & 0xF
+    savegame_version, savegame_chunks, close = _iter_savegame(
+        chunks, chunk_size=chunk_size, chunk_tags=chunk_tags, toc=toc, pipelined=pipelined, stats_callback=stats_callback,
+        map_arrays=map_arrays,
+        table_decoder=_table_compact_records_decoder if compact_records else _table_records_decoder,
+    )
 
-            if chunk_type not in (0, 1, 2, 3, 4):
-                raise ValidationException("Unknown chunk type.")
+    try:
+        return {
+            'savegame_version': savegame_version,
+            'chunks': {
+                tag: {
+                    'headers': headers,
+                    'records': {},
+                    'array': dict(records)['0'],
+                } if map_arrays and tag in _MAP_DTYPES else {
+                    'headers': headers,
+                    'records': {
+                        record_index: record
+                        for record_index, record in records
+                    }
+                }
+                for tag, headers, records in savegame_chunks
+            }
+        }
+    finally:
+        close()
 
-            yield (tag,) + (
-                read_riff_chunk() if chunk_type == 0 else \
-                read_array_chunk() if chunk_type in (1, 2) else \
-                read_table_chunk(tag, chunk_type)
-            )
 
-        # Check tail
+def _parse_savegame_cached(
+    chunks, chunk_size, chunk_tags, output, toc, pipelined, stats_callback, max_workers, map_arrays, compact_records,
+    parse_cache_max_bytes, get_cache_dir,
+):
+    # The cache is keyed by the contents of the savegame, so a stream has to be read in full first
+    if not isinstance(chunks, (str, os.PathLike, bytes, bytearray, memoryview, mmap.mmap)):
+        chunks = b''.join(chunks)
+
+    savegame_sha256 = hashlib.sha256()
+    if isinstance(chunks, (str, os.PathLike)):
+        with open(chunks, 'rb') as f:
+            for block in iter(lambda: f.read(1048576), b''):
+                savegame_sha256.update(block)
+    else:
+        savegame_sha256.update(chunks)
+
+    key = hashlib.sha256(json.dumps([
+        savegame_sha256.hexdigest(), __version__, _SAVEGAME_PARSER_VERSION, output, map_arrays, compact_records,
+        None if chunk_tags is None else sorted(chunk_tags),
+    ]).encode()).hexdigest()
+    parse_cache_dir = os.path.join(get_cache_dir(), 'parsed-savegames')
+    Path(parse_cache_dir).mkdir(parents=True, exist_ok=True)
+    cached_file = os.path.join(parse_cache_dir, f'{key}.pickle')
+
+    try:
+        with open(cached_file, 'rb') as f:
+            game = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        pass
+    else:
+        # The modification time is the time last used, for least recently used eviction
         try:
-            uint8(inner_read)
-        except ValidationException:
+            os.utime(cached_file)
+        except OSError:
             pass
-        else:
-            raise ValidationException(f"Junk at the end of file.")
+        return game
 
-    outer_read, outer_read_iter, _ = get_readers(chunks)
-    compression = outer_read(4)
-    savegame_version = uint16(outer_read)
-    uint16(outer_read)
+    game = parse_savegame(
+        chunks, chunk_size=chunk_size, chunk_tags=chunk_tags, output=output, toc=toc, pipelined=pipelined,
+        stats_callback=stats_callback, max_workers=max_workers, map_arrays=map_arrays, compact_records=compact_records,
+    )
 
+    # Written to a temporary file first so concurrent readers never see a partial file
+    with tempfile.NamedTemporaryFile('wb', dir=parse_cache_dir, suffix='.tmp', delete=False) as f:
+        pickle.dump(game, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(f.name, cached_file)
+    _evict_least_recently_used(parse_cache_dir, parse_cache_max_bytes, os.path.getsize(cached_file))
+
+    return game
+
+
+def _decompress_savegame(chunks):
+    # Returns the entire savegame decompressed, as an OTTN savegame
+    if isinstance(chunks, (str, os.PathLike)):
+        with open(chunks, 'rb') as f:
+            contents = f.read()
+    elif isinstance(chunks, (bytes, bytearray, memoryview, mmap.mmap)):
+        contents = memoryview(chunks).cast('B')
+    else:
+        contents = b''.join(chunks)
+
+    decompressors = {
+        b"OTTN": bytes,
+        b"OTTZ": zlib.decompress,
+        b"OTTX": lzma.decompress,
+    }
+    compression = bytes(contents[:4])
     try:
         decompressor = decompressors[compression]
     except KeyError:
         raise ValidationException(f"Unknown savegame compression {compression}.")
+    try:
+        return b'OTTN' + bytes(contents[4:8]) + decompressor(contents[8:])
+    except (zlib.error, lzma.LZMAError, EOFError):
+        raise ValidationException("Unable to decompress savegame.")
 
-    inner_read, _, inner_offset = get_readers(decompressor(outer_read_iter()))
 
+def _chunks_toc(uncompressed, chunk_size):
+    # Returns the table of contents of a decompressed savegame with only the offset and size of
+    # each chunk, skipping every record by its size, rather than also indexing every record
+    savegame_version, savegame_chunks, close = _iter_savegame(
+        uncompressed, chunk_size=chunk_size, chunk_tags=None, index=True, index_records=False,
+    )
+    try:
+        return {
+            'savegame_version': savegame_version,
+            'compression': 'OTTN',
+            'chunks': dict(savegame_chunks),
+        }
+    finally:
+        close()
+
+
+# Pools of workers used by parse_savegame with max_workers, by the number of workers. They're
+# reused between calls since starting workers can take longer than decoding a savegame
+_parse_pools = {}
+
+
+def _parse_pool(max_workers):
+    try:
+        return _parse_pools[max_workers]
+    except KeyError:
+        pass
+
+    # Threads can decode in parallel if the GIL is disabled, which avoids copying to processes
+    is_gil_enabled = getattr(sys, '_is_gil_enabled', lambda: True)()
+    pool = _parse_pools[max_workers] = \
+        Pool(processes=max_workers) if is_gil_enabled else \
+        ThreadPool(processes=max_workers)
+    return pool
+
+
+@atexit.register
+def _close_parse_pools():
+    # Not calling these explicitly can result in code coverage not measuring
+    # subprocesses. Even using Pool as a context manager doesn't call these
+    for pool in _parse_pools.values():
+        pool.close()
+        pool.join()
+    _parse_pools.clear()
+
+
+# A forked process can't use the pools of its parent, so it starts its own if it needs them
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_parse_pools.clear)
+
+
+def _parse_savegame_parallel(chunks, chunk_size, chunk_tags, output, toc, max_workers, map_arrays, compact_records):
+    # The entire savegame is decompressed, and a single pass finds the boundaries of its chunks
+    uncompressed = _decompress_savegame(chunks)
+    if toc is None:
+        toc = _chunks_toc(uncompressed, chunk_size)
+
+    # Chunks are self-delimiting, so consecutive chunks can be decoded together as a savegame of
+    # just those chunks. Small chunks are batched to reduce the overhead of sending them to workers
+    wanted_tags = [
+        tag for tag in toc['chunks'].keys()
+        if chunk_tags is None or tag in chunk_tags
+    ]
+
+    # The tiles of the map are views of the decompressed bytes, so are cheaper to make in this
+    # process than to decode in a worker and send back
+    map_tags = [tag for tag in wanted_tags if tag in _MAP_DTYPES] if map_arrays else []
+    map_chunks = \
+        parse_savegame(uncompressed, chunk_tags=map_tags, output=output, toc=toc, map_arrays=True)['chunks'] if map_tags else \
+        {}
+
+    chunk_offsets_and_sizes = sorted(
+        (toc['chunks'][tag]['offset'], toc['chunks'][tag]['size'])
+        for tag in wanted_tags
+        if tag not in map_chunks
+    )
+    batch_max_bytes = max(sum(size for _, size in chunk_offsets_and_sizes) // (max_workers * 4), 1)
+    batches = []
+    batch_bytes = batch_max_bytes
+    for offset, size in chunk_offsets_and_sizes:
+        if batch_bytes + size > batch_max_bytes:
+            batches.append([])
+            batch_bytes = 0
+        batches[-1].append((offset, size))
+        batch_bytes += size
+
+    pool = _parse_pool(max_workers)
+    async_results = [
+        pool.apply_async(_parse_savegame_chunks, args=(
+            uncompressed[:8] + b''.join(uncompressed[8 + offset:8 + offset + size] for offset, size in batch) + b'\0\0\0\0',
+            output, compact_records,
+        ))
+        for batch in batches
+    ]
+    parsed_chunks = {
+        **map_chunks,
+        **{
+            tag: chunk
+            for async_result in async_results
+            for tag, chunk in async_result.get().items()
+        },
+    }
     return {
-        'savegame_version': savegame_version,
+        'savegame_version': toc['savegame_version'],
         'chunks': {
-            tag: {
+            tag: parsed_chunks[tag]
+            for tag in wanted_tags
+        },
+    }
+
+
+class _LazyMapping(Mapping):
+    # Computes the value of each key when it's first accessed, and caches it. It's pickled as a
+    # dict of all the values, for example when returned from a worker in a result row
+
+    def __init__(self, keys, get_value):
+        self._keys = dict.fromkeys(keys)
+        self._get_value = get_value
+        self._values = {}
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            if key not in self._keys:
+                raise
+        value = self._values[key] = self._get_value(key)
+        return value
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def __reduce__(self):
+        return (dict, (dict(self),))
+
+
+def _parse_savegame_lazy(chunks, chunk_size, chunk_tags, toc, stats_callback, compact_records):
+    # Each chunk is decoded from the decompressed savegame when its headers or records are first
+    # accessed, using the offset of the chunk in the table of contents. Without one, only the
+    # offsets of chunks are found up front, and the records of a chunk are only read when the
+    # chunk is first accessed
+    uncompressed = _decompress_savegame(chunks)
+    if toc is None:
+        toc = _chunks_toc(uncompressed, chunk_size)
+
+    def decode_chunk(tag, key):
+        _, savegame_chunks, close = _iter_savegame(
+            uncompressed, chunk_size=chunk_size, chunk_tags=(tag,), toc=toc, stats_callback=stats_callback,
+            table_decoder=_table_compact_records_decoder if compact_records else _table_records_decoder,
+        )
+        try:
+            # The chunks are iterated to the end so stats_callback is called for the chunk
+            for _, headers, records in savegame_chunks:
+                value = \
+                    headers if key == 'headers' else \
+                    {record_index: record for record_index, record in records}
+        finally:
+            close()
+        return value
+
+    return {
+        'savegame_version': toc['savegame_version'],
+        'chunks': _LazyMapping(
+            (tag for tag in toc['chunks'] if chunk_tags is None or tag in chunk_tags),
+            lambda tag: _LazyMapping(('headers', 'records'), partial(decode_chunk, tag)),
+        ),
+    }
+
+
+def _parse_savegame_chunks(chunks, output, compact_records):
+    return parse_savegame(chunks, output=output, compact_records=compact_records)['chunks']
+
+
+# The total size of the files in each cache directory, found by scanning it on first use and
+# then added to as this process writes files to it
+_cache_dirs_bytes = {}
+
+
+def _evict_least_recently_used(cache_dir, max_bytes, written_bytes):
+    # The directory is only scanned when the running total goes over max_bytes, so writes don't
+    # each stat every file. Files written by other processes are counted on the next scan
+    total_bytes = _cache_dirs_bytes.get(cache_dir)
+    if total_bytes is not None:
+        total_bytes = _cache_dirs_bytes[cache_dir] = total_bytes + written_bytes
+        if total_bytes <= max_bytes:
+            return
+
+    cached_files = []
+    for direntry in os.scandir(cache_dir):
+        if not direntry.name.endswith('.pickle'):
+            continue
+        try:
+            direntry_stat = direntry.stat()
+        except FileNotFoundError:
+            # Evicted by another process
+            continue
+        cached_files.append((direntry_stat.st_mtime_ns, direntry_stat.st_size, direntry.path))
+
+    total_bytes = 0
+    kept_bytes = 0
+    for _, size, path in sorted(cached_files, reverse=True):
+        total_bytes += size
+        if total_bytes > max_bytes:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        else:
+            kept_bytes = total_bytes
+    _cache_dirs_bytes[cache_dir] = kept_bytes
+
+
+def _parse_savegame_columns(chunks, chunk_size, chunk_tags, toc, pipelined, stats_callback, map_arrays):
+    import numpy as np
+
+    savegame_version, savegame_chunks, close = _iter_savegame(
+        chunks, chunk_size=chunk_size, chunk_tags=chunk_tags, table_decoder=_table_columns_decoder, toc=toc,
+        pipelined=pipelined, stats_callback=stats_callback, map_arrays=map_arrays,
+    )
+
+    def chunk_columns(tag, headers, records):
+        # Only table chunks have columns
+        if not isinstance(headers, tuple):
+            return {
                 'headers': headers,
-                'records': {
-                    record_index: record
-                    for record_index, record in records
-                }
+                'index': np.zeros(0, dtype=np.int64),
+                'columns': {},
+                **({'array': dict(records)['0']} if map_arrays and tag in _MAP_DTYPES else {}),
+            }
+
+        headers, to_arrays = headers
+        return {
+            'headers': headers,
+            'index': np.array([int(record_index) for record_index, _ in records], dtype=np.int64),
+            'columns': to_arrays(),
+        }
+
+    try:
+        return {
+            'savegame_version': savegame_version,
+            'chunks': {
+                tag: chunk_columns(tag, headers, records)
+                for tag, headers, records in savegame_chunks
             }
-            for tag, headers, records in read_chunks(inner_read, inner_offset)
         }
+    finally:
+        close()
+
+
+def _query_savegame(chunks, fields, chunk_size, stats_callback=None):
+    # Each field is of the form <tag>.<record index or *>.<path of field in record>
+    paths_by_tag = defaultdict(set)
+    indexes_and_paths_by_tag = defaultdict(list)
+    for field in fields:
+        parts = field.split('.', 2)
+        if len(parts) < 2 or len(parts[0]) != 4:
+            raise ValueError(f"Invalid field {field}")
+        tag, index, path = (parts + [''])[:3]
+        paths_by_tag[tag].add(path)
+        indexes_and_paths_by_tag[tag].append((index, path))
+
+    def table_decoder(tag, header_bytes):
+        headers, decode_selected = _table_selective_decoder(header_bytes, frozenset(paths_by_tag[tag]))
+        return headers, decode_selected
+
+    savegame_version, savegame_chunks, close = _iter_savegame(
+        chunks, chunk_size=chunk_size, chunk_tags=paths_by_tag.keys(), table_decoder=table_decoder,
+        stats_callback=stats_callback,
+    )
+
+    try:
+        return savegame_version, {
+            f'{tag}.{record_index}.{path}' if path else f'{tag}.{record_index}': selected[path]
+            for tag, _, records in savegame_chunks
+            for record_index, selected in records
+            for index, path in indexes_and_paths_by_tag[tag]
+            if index in ('*', record_index) and path in selected
+        }
+    finally:
+        close()
+
+
+def query_savegame(chunks, fields, chunk_size=65536):
+    _, values = _query_savegame(chunks, fields, chunk_size=chunk_size)
+    return values
+
+
+def _savegame_delta(chunks, chunk_size, chunk_tags, previous, stats_callback=None, compact_records=False):
+    # Compares the bytes of each record with the bytes of the record with the same index in the
+    # previous savegame, and only decodes the records that differ. Returns the delta, and the
+    # bytes of this savegame to compare the next savegame against
+    header_bytes_by_tag = {}
+
+    def table_decoder(tag, header_bytes):
+        header_bytes_by_tag[tag] = header_bytes
+        headers, decode_record = \
+            _table_compact_records_decoder(tag, header_bytes) if compact_records else \
+            _table_records_decoder(tag, header_bytes)
+
+        def decode_record_later(buf, pos):
+            record_bytes = bytes(buf)
+            return (record_bytes, partial(_decode_record_bytes, decode_record, tag, record_bytes, pos)), len(record_bytes)
+
+        return headers, decode_record_later
+
+    def chunk_delta(tag, headers, records):
+        previous_header_bytes, previous_record_bytes = previous.get(tag, (None, {}))
+        header_bytes = header_bytes_by_tag.get(tag)
+
+        # If the headers have changed then the same bytes could be different values
+        same_headers = header_bytes == previous_header_bytes
+        record_bytes = {}
+        added = {}
+        changed = {}
+        for record_index, (current_record_bytes, decode) in records:
+            record_bytes[record_index] = current_record_bytes
+            previous_bytes = previous_record_bytes.get(record_index)
+            if same_headers and previous_bytes == current_record_bytes:
+                continue
+            (added if previous_bytes is None else changed)[record_index] = decode()
+
+        return (header_bytes, record_bytes), {
+            'headers': headers,
+            'added': added,
+            'changed': changed,
+            'removed': [
+                record_index for record_index in previous_record_bytes
+                if record_index not in record_bytes
+            ],
+        }
+
+    savegame_version, savegame_chunks, close = _iter_savegame(
+        chunks, chunk_size=chunk_size, chunk_tags=chunk_tags, table_decoder=table_decoder, stats_callback=stats_callback,
+    )
+    current = {}
+    delta_chunks = {}
+    try:
+        for tag, headers, records in savegame_chunks:
+            current[tag], delta_chunk = chunk_delta(tag, headers, records)
+            if tag not in previous or delta_chunk['added'] or delta_chunk['changed'] or delta_chunk['removed']:
+                delta_chunks[tag] = delta_chunk
+    finally:
+        close()
+
+    return {
+        'savegame_version': savegame_version,
+        'chunks': delta_chunks,
+        'removed_chunks': [tag for tag in previous if tag not in current],
+    }, current
+
+
+def diff_savegames(savegames, chunk_size=65536, chunk_tags=None, compact_records=False):
+    previous = {}
+    for savegame in savegames:
+        delta, previous = _savegame_delta(savegame, chunk_size, chunk_tags, previous, compact_records=compact_records)
+        yield delta
+
+
+def apply_savegame_delta(savegame, delta):
+    chunks = {} if savegame is None else savegame['chunks']
+    removed_chunks = frozenset(delta['removed_chunks'])
+
+    def apply_chunk_delta(records, chunk_delta):
+        removed = frozenset(chunk_delta['removed'])
+        return {
+            record_index: record
+            for record_index, record in itertools.chain(
+                records.items(), chunk_delta['added'].items(), chunk_delta['changed'].items(),
+            )
+            if record_index not in removed
+        }
+
+    return {
+        'savegame_version': delta['savegame_version'],
+        'chunks': {
+            **{
+                tag: chunk
+                for tag, chunk in chunks.items()
+                if tag not in removed_chunks
+            },
+            **{
+                tag: {
+                    'headers': chunk_delta['headers'],
+                    'records': apply_chunk_delta(chunks[tag]['records'] if tag in chunks else {}, chunk_delta),
+                }
+                for tag, chunk_delta in delta['chunks'].items()
+            },
+        },
+    }
+
+
+def link_graphs(savegame):
+    import numpy as np
+
+    # The link graph chunks are parsed into columns unless an already parsed savegame is passed
+    if not (isinstance(savegame, dict) and 'chunks' in savegame):
+        savegame = parse_savegame(savegame, chunk_tags=('MAPS', 'LGRP'), output='columns')
+    chunks = savegame['chunks']
+    columns, dim_x = \
+        (chunks['LGRP']['columns'], int(chunks['MAPS']['columns']['dim_x'][0])) if 'columns' in chunks['LGRP'] else \
+        (_link_graph_columns(chunks['LGRP']['records']), chunks['MAPS']['records']['0']['dim_x'])
+
+    node_offsets = columns['nodes.offsets']
+    edge_offsets = columns['nodes.edges.offsets']
+    num_nodes = len(edge_offsets) - 1
+    graph_of_node = np.repeat(np.arange(len(node_offsets) - 1), np.diff(node_offsets))
+    node_of_edge = np.repeat(np.arange(num_nodes), np.diff(edge_offsets))
+
+    # From savegame version 304 each edge has its destination. Before, the edges of each node are
+    # a linked list that starts with the edge to itself, and the destination of each edge is the
+    # next_edge of the edge before it
+    if 'nodes.edges.dest_node' in columns:
+        destination_in_graph = columns['nodes.edges.dest_node'].astype(np.int64)
+        is_edge = np.ones(len(destination_in_graph), dtype=bool)
+    else:
+        next_edge = columns['nodes.edges.next_edge'].astype(np.int64)
+        destination_in_graph = np.zeros(len(next_edge), dtype=np.int64)
+        destination_in_graph[1:] = next_edge[:-1]
+        is_edge = np.ones(len(next_edge), dtype=bool)
+        is_edge[edge_offsets[:-1][np.diff(edge_offsets) > 0]] = False
+
+    source = node_of_edge[is_edge]
+    destination = node_offsets[graph_of_node[source]] + destination_in_graph[is_edge]
+    xy = columns['nodes.xy'].astype(np.int64)
+    distance = \
+        np.abs(xy[source] % dim_x - xy[destination] % dim_x) + \
+        np.abs(xy[source] // dim_x - xy[destination] // dim_x)
+
+    # There can be more than one link graph for a cargo, each of a separate component of the
+    # network, so they are combined into a single graph for each cargo
+    cargo_of_node = columns['cargo'][graph_of_node]
+    cargo_of_edge = cargo_of_node[source]
+    index_in_cargo = np.zeros(num_nodes, dtype=np.int64)
+
+    def cargo_link_graph(cargo):
+        nodes = np.flatnonzero(cargo_of_node == cargo)
+        index_in_cargo[nodes] = np.arange(len(nodes))
+        edges = cargo_of_edge == cargo
+        indptr = np.zeros(len(nodes) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(index_in_cargo[source[edges]], minlength=len(nodes)), out=indptr[1:])
+        return {
+            'node_ids': columns['nodes.station'][nodes],
+            'node_xy': columns['nodes.xy'][nodes],
+            'indptr': indptr,
+            'indices': index_in_cargo[destination[edges]],
+            'capacity': columns['nodes.edges.capacity'][is_edge][edges],
+            'usage': columns['nodes.edges.usage'][is_edge][edges],
+            # Savegames from before edges had a travel time don't have travel_time_sum
+            **({
+                'travel_time_sum': columns['nodes.edges.travel_time_sum'][is_edge][edges],
+            } if 'nodes.edges.travel_time_sum' in columns else {}),
+            'distance': distance[edges],
+        }
+
+    return {
+        int(cargo): cargo_link_graph(cargo)
+        for cargo in np.unique(columns['cargo'])
     }
 
 
+def _link_graph_columns(records):
+    # The same columns as from parsing with output='columns', but from parsed records
+    import numpy as np
+
+    graphs = list(records.values())
+    nodes = [node for graph in graphs for node in graph['nodes']]
+    edges = [edge for node in nodes for edge in node['edges']]
+    edge_keys = \
+        ('capacity', 'usage') + \
+        (('travel_time_sum',) if edges and 'travel_time_sum' in edges[0] else ()) + \
+        (('dest_node',) if edges and 'dest_node' in edges[0] else ('next_edge',))
+
+    return {
+        'cargo': np.array([graph['cargo'] for graph in graphs], dtype=np.uint8),
+        'nodes.offsets': np.cumsum([0] + [len(graph['nodes']) for graph in graphs], dtype=np.int64),
+        'nodes.xy': np.array([node['xy'] for node in nodes], dtype=np.uint32),
+        'nodes.station': np.array([node['station'] for node in nodes], dtype=np.uint16),
+        'nodes.edges.offsets': np.cumsum([0] + [len(node['edges']) for node in nodes], dtype=np.int64),
+        **{
+            f'nodes.edges.{key}': np.array([edge[key] for edge in edges], dtype=np.uint64 if key == 'travel_time_sum' else np.int64)
+            for key in edge_keys
+        },
+    }
+
+
+def _date_from_days(days_since_year_zero):
+    # Python (and indeed, the gregorian calendar) doesn't have a year zero,
+    # and according to the OpenTTD source, year 1 was a leap year
+    days_since_year_one = days_since_year_zero - 366
+    return date(1, 1 , 1) + timedelta(days_since_year_one)
+
+
+def _savegame_date(game):
+    return _date_from_days(game['chunks']['DATE']['records']['0']['date'])
+
+
+def _chunk_tags_and_fields(chunk_tags, fields):
+    if chunk_tags is not None and fields is not None:
+        raise ValueError('Only one of chunk_tags and fields can be passed')
+    return \
+        None if chunk_tags is None else tuple(chunk_tags), \
+        None if fields is None else tuple(fields)
+
+
+def _parse_savegame_row_values(path, chunk_tags, fields, parse_cache_dir_and_max_bytes, stats_callback=None, compact_records=False, lazy=False):
+    # The date of the savegame is always needed to populate the date of each row
+    if fields is None:
+        parse_cache_dir, parse_cache_max_bytes = parse_cache_dir_and_max_bytes or (None, None)
+        game = parse_savegame(
+            path,
+            chunk_tags=None if chunk_tags is None else set(chunk_tags) | {'DATE'},
+            parse_cache=parse_cache_dir_and_max_bytes is not None,
+            parse_cache_max_bytes=parse_cache_max_bytes,
+            get_cache_dir=lambda: parse_cache_dir,
+            stats_callback=stats_callback,
+            compact_records=compact_records,
+            lazy=lazy,
+        )
+        return {
+            'savegame_version': game['savegame_version'],
+            'date': _savegame_date(game),
+            'chunks': _LazyMapping(game['chunks'], lambda tag: game['chunks'][tag]['records']) if lazy else {
+                tag: chunk['records'] for tag, chunk in game['chunks'].items()
+            },
+        }
+
+    savegame_version, values = _query_savegame(path, set(fields) | {'DATE.0.date'}, chunk_size=65536, stats_callback=stats_callback)
+    return {
+        'savegame_version': savegame_version,
+        'date': _date_from_days(values['DATE.0.date']),
+        'chunks': {},
+        'fields': values if 'DATE.0.date' in fields else {
+            path: value for path, value in values.items() if path != 'DATE.0.date'
+        },
+    }
+
+
+def _savegame_delta_row_values(path, chunk_tags, previous_savegame, stats_callback=None, compact_records=False):
+    # The DATE record is only in the delta if it changed, so the previous date is kept for the
+    # rare case that it didn't
+    delta, previous_savegame['records'] = _savegame_delta(
+        path, 65536, None if chunk_tags is None else set(chunk_tags) | {'DATE'}, previous_savegame.get('records', {}),
+        stats_callback=stats_callback, compact_records=compact_records,
+    )
+    date_delta = delta['chunks'].get('DATE', {'added': {}, 'changed': {}})
+    date_record = date_delta['added'].get('0') or date_delta['changed'].get('0')
+    if date_record is not None:
+        previous_savegame['date'] = _date_from_days(date_record['date'])
+    return {
+        **delta,
+        'date': previous_savegame['date'],
+    }
+
+
+def parse_savegames(
+    paths=(),
+    max_workers=None,
+    result_processor=lambda x: (x,),
+    chunk_tags=None,
+    fields=None,
+    parse_cache=False,
+    parse_cache_max_bytes=1000000000,
+    compact_records=False,
+    lazy=False,
+    get_cache_dir=lambda: _user_cache_dir(),
+):
+    from dill import dumps, loads
+
+    max_workers = \
+        max_workers if max_workers is not None else \
+        (os.cpu_count() or 1)
+
+    # Only a bounded number of savegames are submitted to the pool at any one time, so memory use
+    # does not depend on the number of paths, which can be a lazy iterable, or on the number of
+    # savegames in archives
+    max_in_flight = max_workers * 2
+    sources = _savegame_sources(paths)
+    result_processor_dumped = dumps(result_processor)
+    chunk_tags, fields = _chunk_tags_and_fields(chunk_tags, fields)
+    if lazy and (fields is not None or parse_cache):
+        raise ValueError('lazy cannot be used with fields or parse_cache')
+    parse_cache_dir_and_max_bytes = (get_cache_dir(), parse_cache_max_bytes) if parse_cache else None
+    completed = queue.Queue()
+
+    pool = Pool(processes=max_workers)
+    finished = False
+    try:
+        def submit(path, source):
+            pool.apply_async(
+                _parse_savegame_rows,
+                args=(path, source, result_processor_dumped, chunk_tags, fields, parse_cache_dir_and_max_bytes, compact_records, lazy),
+                callback=lambda rows: completed.put((True, rows)),
+                error_callback=lambda e: completed.put((False, e)),
+            )
+
+        in_flight = 0
+        for path, source in itertools.islice(sources, max_in_flight):
+            submit(path, source)
+            in_flight += 1
+
+        while in_flight:
+            success, rows_or_exception = completed.get()
+            in_flight -= 1
+            if not success:
+                raise rows_or_exception
+
+            for path, source in itertools.islice(sources, 1):
+                submit(path, source)
+                in_flight += 1
+
+            yield from loads(rows_or_exception)
+        finished = True
+    finally:
+        # If stopped early, for example on error, savegames still being parsed are not waited for
+        if not finished:
+            pool.terminate()
+        # Not calling these explicitly can result in code coverage not measuring
+        # subprocesses. Even using Pool as a context manager doesn't call these
+        pool.close()
+        pool.join()
+        sources.close()
+
+
+def _parse_savegame_rows(path, source, result_processor, chunk_tags, fields, parse_cache_dir_and_max_bytes, compact_records, lazy):
+    from dill import dumps, loads
+
+    result_processor = loads(result_processor)
+    return dumps(list(result_processor({
+        'path': path,
+        **_parse_savegame_row_values(
+            source() if callable(source) else source,
+            chunk_tags, fields, parse_cache_dir_and_max_bytes, compact_records=compact_records, lazy=lazy,
+        ),
+    })))
+
+
+_COMPRESSED_TAR_EXTENSIONS = ('.tar.gz', '.tgz', '.tar.xz', '.txz', '.tar.bz2', '.tbz2')
+
+
+def _savegame_sources(paths):
+    # Yields the path of each savegame for its result row, and the source of its contents that is
+    # sent to a worker: the path itself, a function that reads the savegame from an archive, or
+    # for compressed tar files that can only be read sequentially, the bytes of the savegame
+    for path in paths:
+        lower_path = os.fspath(path).lower()
+        if lower_path.endswith('.tar'):
+            # Stream mode reads the archive sequentially, but since it's uncompressed the offset of
+            # each member in the file is known, so workers read savegames from the archive themselves
+            with tarfile.open(path, 'r|') as f_tar:
+                for member in f_tar:
+                    if member.isfile() and member.name.lower().endswith('.sav'):
+                        yield os.path.join(path, member.name), partial(_tar_member_contents, path, member.offset_data, member.size)
+        elif lower_path.endswith(_COMPRESSED_TAR_EXTENSIONS):
+            with tarfile.open(path, 'r|*') as f_tar:
+                for member in f_tar:
+                    if member.isfile() and member.name.lower().endswith('.sav'):
+                        yield os.path.join(path, member.name), f_tar.extractfile(member).read()
+        elif lower_path.endswith('.zip'):
+            with zipfile.ZipFile(path, 'r') as f_zip:
+                for info in f_zip.infolist():
+                    if not info.is_dir() and info.filename.lower().endswith('.sav'):
+                        yield os.path.join(path, info.filename), partial(_zip_member_contents, path, info.filename)
+        else:
+            yield path, path
+
+
+def _tar_member_contents(archive_path, offset, size):
+    with open(archive_path, 'rb') as f:
+        f.seek(offset)
+        contents = f.read(size)
+    if len(contents) != size:
+        raise ValidationException("Unexpected end-of-file.")
+    return contents
+
+
+def _zip_member_contents(archive_path, name):
+    with zipfile.ZipFile(archive_path, 'r') as f_zip:
+        return f_zip.read(name)
+
+
+def _savegame_paths(paths):
+    # Directories are walked lazily, so even directories with very many savegames are not
+    # listed in memory in one go
+    for path in paths:
+        if os.path.isdir(path):
+            for dir_path, dir_names, file_names in os.walk(path):
+                dir_names.sort()
+                for file_name in sorted(file_names):
+                    if file_name.lower().endswith(('.sav', '.tar', '.zip') + _COMPRESSED_TAR_EXTENSIONS):
+                        yield os.path.join(dir_path, file_name)
+        else:
+            yield path
+
+
+def _json_dumps(value):
+    # Mappings that are not dicts, such as CompactRecord, are converted to dicts so they are
+    # encoded as JSON objects, and values JSON has no type for, such as dates, as strings
+    def plain(value):
+        return \
+            {key: plain(sub_value) for key, sub_value in value.items()} if isinstance(value, Mapping) else \
+            [plain(sub_value) for sub_value in value] if isinstance(value, (list, tuple)) else \
+            value
+
+    return json.dumps(plain(value), default=str)
+
+
+def jsonl_sink(path):
+    @contextlib.contextmanager
+    def open_writer():
+        with open(path, 'w', encoding='utf-8') as f:
+            def write(experiment_index, rows):
+                for row in rows:
+                    f.write(_json_dumps({'experiment_index': experiment_index, **row}) + '\n')
+                # So the rows of finished experiments are not lost if the process crashes
+                f.flush()
+            yield write
+
+    def read_rows():
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                yield json.loads(line)
+
+    return open_writer, read_rows
+
+
+def parquet_sink(directory):
+    # Values of types that Parquet has, but not of those it does not, such as a dict of the experiment
+    # containing AIs, or a CompactRecord, are written as JSON, as jsonl_sink and sqlite_sink would
+    scalar_types = (bool, int, float, str, bytes, date)
+
+    def arrow_row(row):
+        return {
+            key: value if value is None or isinstance(value, scalar_types) else _json_dumps(value)
+            for key, value in row.items()
+        }
+
+    def partition_dirs():
+        return sorted((
+            (int(name.split('=', 1)[1]), os.path.join(directory, name))
+            for name in os.listdir(directory)
+            if name.startswith('experiment_index=')
+        ), key=lambda index_and_dir: index_and_dir[0])
+
+    @contextlib.contextmanager
+    def open_writer():
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        Path(directory).mkdir(parents=True, exist_ok=True)
+        for _, partition_dir in partition_dirs():
+            shutil.rmtree(partition_dir)
+
+        def write(experiment_index, rows):
+            # Each experiment is a Hive-style partition, written to a temporary file first so a
+            # crash never leaves a partial file
+            partition_dir = os.path.join(directory, f'experiment_index={experiment_index}')
+            Path(partition_dir).mkdir()
+            with tempfile.NamedTemporaryFile(dir=partition_dir, suffix='.tmp', delete=False) as f:
+                pq.write_table(pa.Table.from_pylist([arrow_row(row) for row in rows]), f)
+            os.replace(f.name, os.path.join(partition_dir, 'part-0.parquet'))
+
+        yield write
+
+    def read_rows():
+        import pyarrow.parquet as pq
+
+        for experiment_index, partition_dir in partition_dirs():
+            for row in pq.read_table(os.path.join(partition_dir, 'part-0.parquet')).to_pylist():
+                yield {'experiment_index': experiment_index, **row}
+
+    return open_writer, read_rows
+
+
+def sqlite_sink(path, table='results'):
+    quoted_table = '"' + table.replace('"', '""') + '"'
+    quoted_index = '"' + (table + '_experiment_index_date').replace('"', '""') + '"'
+
+    @contextlib.contextmanager
+    def open_writer():
+        import sqlite3
+
+        with contextlib.closing(sqlite3.connect(path)) as connection:
+            with connection:
+                connection.execute(f'DROP TABLE IF EXISTS {quoted_table}')
+                connection.execute(f'CREATE TABLE {quoted_table} (experiment_index INTEGER NOT NULL, date TEXT, row TEXT NOT NULL)')
+                connection.execute(f'CREATE INDEX {quoted_index} ON {quoted_table} (experiment_index, date)')
+
+            def write(experiment_index, rows):
+                # Each experiment is committed in its own transaction
+                with connection:
+                    connection.executemany(f'INSERT INTO {quoted_table} VALUES (?, ?, ?)', (
+                        (
+                            experiment_index,
+                            None if row.get('date') is None else str(row['date']),
+                            _json_dumps(row),
+                        )
+                        for row in rows
+                    ))
+
+            yield write
+
+    def read_rows():
+        import sqlite3
+
+        with contextlib.closing(sqlite3.connect(path)) as connection:
+            for experiment_index, row in connection.execute(f'SELECT experiment_index, row FROM {quoted_table} ORDER BY experiment_index, rowid'):
+                yield {'experiment_index': experiment_index, **json.loads(row)}
+
+    return open_writer, read_rows
+
+
+def _write_jsonl(output_path, rows):
+    with open(output_path, 'w', encoding='utf-8') as f:
+        for row in rows:
+            f.write(_json_dumps(row) + '\n')
+
+
+def _write_parquet(output_path, rows):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    # The chunks of a savegame each have different fields, so to have a single schema each
+    # record is a row, with the record itself encoded as JSON
+    schema = pa.schema([
+        ('path', pa.string()),
+        ('savegame_version', pa.int32()),
+        ('date', pa.date32()),
+        ('tag', pa.string()),
+        ('index', pa.string()),
+        ('record', pa.string()),
+    ])
+    with pq.ParquetWriter(output_path, schema) as writer:
+        for row in rows:
+            # Selected fields are grouped into records, keyed by their path within the record
+            fields_records = defaultdict(dict)
+            for field, value in row.get('fields', {}).items():
+                tag, record_index, path = (field.split('.', 2) + [''])[:3]
+                fields_records[(tag, record_index)][path] = value
+            records = [
+                (tag, record_index, _json_dumps(record))
+                for tag, chunk_records in row['chunks'].items()
+                for record_index, record in chunk_records.items()
+            ] + [
+                (tag, record_index, _json_dumps(record))
+                for (tag, record_index), record in fields_records.items()
+            ]
+            writer.write_table(pa.table({
+                'path': [str(row['path'])] * len(records),
+                'savegame_version': [row['savegame_version']] * len(records),
+                'date': [row['date']] * len(records),
+                'tag': [tag for tag, _, _ in records],
+                'index': [record_index for _, record_index, _ in records],
+                'record': [record for _, _, record in records],
+            }, schema=schema))
+
+
+def _main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m openttdlab')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parse_parser = subparsers.add_parser('parse', help='Parse savegame files in parallel')
+    parse_parser.add_argument('paths', nargs='+', help='Savegame files, or directories that are searched for .sav files')
+    parse_parser.add_argument('--output', required=True, help='File to write the parsed savegames to')
+    parse_parser.add_argument('--format', choices=('jsonl', 'parquet'), default='jsonl')
+    parse_parser.add_argument('--chunk-tags', help='Comma separated tags of the chunks to parse, for example DATE,PLYR')
+    parse_parser.add_argument('--fields', help='Comma separated fields to parse, for example DATE.0.date,PLYR.*.money')
+    parse_parser.add_argument('--max-workers', type=int, default=None)
+    parse_parser.add_argument('--compact-records', action='store_true', help='Parse records into CompactRecords to use less memory')
+
+    args = parser.parse_args(argv)
+    rows = parse_savegames(
+        _savegame_paths(args.paths),
+        max_workers=args.max_workers,
+        chunk_tags=args.chunk_tags.split(',') if args.chunk_tags else None,
+        fields=args.fields.split(',') if args.fields else None,
+        compact_records=args.compact_records,
+    )
+    writers = {
+        'jsonl': _write_jsonl,
+        'parquet': _write_parquet,
+    }
+    writers[args.format](args.output, rows)
+
+
 class ValidationException(Exception):
     pass
+
+
+if __name__ == '__main__':
+    # Running via the imported module rather than __main__ means that functions sent to worker
+    # processes are pickled with references to the openttdlab module, which workers can import
+    import openttdlab
+    openttdlab._main(sys.argv[1:])
@@ -1,14 +1,37 @@
+import itertools
 import json
+import lzma
 import os
+import pickle
+import subprocess
+import sys
 import tarfile
 import tempfile
+import textwrap
+import zipfile
+import zlib
+from collections.abc import Mapping, Sequence
 from datetime import date
 
 import pytest
 
 from openttdlab import (
+    CompactRecord,
+    ValidationException,
+    apply_savegame_delta,
+    diff_savegames,
+    inspect_savegame,
+    iter_experiments,
+    iter_savegame,
+    jsonl_sink,
+    link_graphs,
     parse_savegame,
+    parse_savegame_records,
+    parse_savegames,
+    parquet_sink,
+    query_savegame,
     run_experiments,
+    sqlite_sink,
     local_folder,
     local_file,
     remote_file,
@@ -233,6 +256,255 @@ def test_run_experiments_local_folder():
         'error': False,
     }
 
+def test_run_experiments_parse_stats():
+    parse_stats = []
+    results = run_experiments(
+        experiments=(
+            {
+                'seed': seed,
+                'ais': (
+                    local_folder('./fixtures/NoOpAIImportingPathfinder-1', 'NoOpAIImportingPathfinder'),
+                ),
+                'days': 366 * 1 + 1,
+            }
+            for seed in range(0, 2)
+        ),
+        ai_libraries=(
+            bananas_ai_library('5046524f', 'Pathfinder.Road'),
+        ),
+        openttd_version='13.4',
+        opengfx_version='7.1',
+        result_processor=_basic_data,
+        parse_stats_callback=lambda experiment, stats: parse_stats.append((experiment['seed'], stats)),
+    )
+
+    assert len(results) == 24
+    assert sorted(seed for seed, _ in parse_stats) == [0, 1]
+    for _, stats in parse_stats:
+        assert stats['PLYR']['num_records'] == 12
+        assert stats['PLYR']['decompressed_bytes'] > 0
+
+
+def test_iter_experiments():
+    results = list(iter_experiments(
+        experiments=(
+            {
+                'seed': seed,
+                'ais': (
+                    local_folder('./fixtures/NoOpAIImportingPathfinder-1', 'NoOpAIImportingPathfinder'),
+                ),
+                'days': 366 * 1 + 1,
+            }
+            for seed in range(0, 3)
+        ),
+        ai_libraries=(
+            bananas_ai_library('5046524f', 'Pathfinder.Road'),
+        ),
+        openttd_version='13.4',
+        opengfx_version='7.1',
+        max_workers=1,
+        result_processor=_basic_data,
+    ))
+
+    assert len(results) == 36
+    for experiment_index, row in results:
+        assert row['seed'] == experiment_index
+    for experiment_index in range(0, 3):
+        dates = [row['date'] for i, row in results if i == experiment_index]
+        assert dates == sorted(dates)
+
+
+@pytest.mark.parametrize('get_sink, filename', [
+    (jsonl_sink, 'results.jsonl'),
+    (parquet_sink, 'results'),
+    (sqlite_sink, 'results.sqlite'),
+])
+def test_run_experiments_sink(tmp_path, get_sink, filename):
+    if get_sink is parquet_sink:
+        pytest.importorskip('pyarrow')
+
+    read_rows = run_experiments(
+        experiments=(
+            {
+                'seed': seed,
+                'ais': (
+                    local_folder('./fixtures/NoOpAIImportingPathfinder-1', 'NoOpAIImportingPathfinder'),
+                ),
+                'days': 366 * 1 + 1,
+            }
+            for seed in range(0, 2)
+        ),
+        ai_libraries=(
+            bananas_ai_library('5046524f', 'Pathfinder.Road'),
+        ),
+        openttd_version='13.4',
+        opengfx_version='7.1',
+        result_processor=lambda row: ({
+            'seed': row['experiment']['seed'],
+            'date': row['date'],
+            'money': row['chunks']['PLYR']['0']['money'],
+        },),
+        sink=get_sink(str(tmp_path / filename)),
+    )
+
+    rows = list(read_rows())
+    assert len(rows) == 24
+    for row in rows:
+        assert row['experiment_index'] == row['seed']
+        assert str(row['date']).startswith('1950-')
+
+
+def test_run_experiments_parse_while_running():
+    def run(parse_while_running):
+        return run_experiments(
+            experiments=(
+                {
+                    'seed': seed,
+                    'ais': (
+                        local_folder('./fixtures/NoOpAIImportingPathfinder-1', 'NoOpAIImportingPathfinder'),
+                    ),
+                    'days': 366 * 1 + 1,
+                }
+                for seed in range(0, 2)
+            ),
+            ai_libraries=(
+                bananas_ai_library('5046524f', 'Pathfinder.Road'),
+            ),
+            openttd_version='13.4',
+            opengfx_version='7.1',
+            result_processor=_basic_data,
+            parse_while_running=parse_while_running,
+        )
+
+    results = run(parse_while_running=True)
+    assert len(results) == 24
+    assert results == run(parse_while_running=False)
+
+
+def test_run_experiments_run_dir_root(tmp_path):
+    (tmp_path / 'run').mkdir()
+    (tmp_path / 'final').mkdir()
+    results = run_experiments(
+        experiments=(
+            {
+                'seed': seed,
+                'ais': (
+                    local_folder('./fixtures/NoOpAIImportingPathfinder-1', 'NoOpAIImportingPathfinder'),
+                ),
+                'days': 366 * 1 + 1,
+            }
+            for seed in range(0, 2)
+        ),
+        ai_libraries=(
+            bananas_ai_library('5046524f', 'Pathfinder.Road'),
+        ),
+        openttd_version='13.4',
+        opengfx_version='7.1',
+        result_processor=_basic_data,
+        run_dir_root=str(tmp_path / 'run'),
+        final_savegame_directory=str(tmp_path / 'final'),
+        parse_while_running=True,
+    )
+
+    assert len(results) == 24
+    assert os.listdir(tmp_path / 'run') == []
+    assert sorted(os.listdir(tmp_path / 'final')) == ['0.sav', '1.sav']
+    for seed in range(0, 2):
+        final_savegame = parse_savegame(str(tmp_path / 'final' / f'{seed}.sav'), chunk_tags=('DATE',))
+        assert final_savegame['savegame_version'] > 0
+
+
+def test_run_experiments_experiment_cache(tmp_path):
+    def run(seeds, extra_experiments=()):
+        return run_experiments(
+            experiments=tuple(
+                {
+                    'seed': seed,
+                    'ais': (
+                        local_folder('./fixtures/NoOpAIImportingPathfinder-1', 'NoOpAIImportingPathfinder'),
+                    ),
+                    'days': 366 * 1 + 1,
+                }
+                for seed in seeds
+            ) + tuple(extra_experiments),
+            ai_libraries=(
+                bananas_ai_library('5046524f', 'Pathfinder.Road'),
+            ),
+            openttd_version='13.4',
+            opengfx_version='7.1',
+            result_processor=_basic_data,
+            experiment_cache=True,
+            get_cache_dir=lambda: str(tmp_path),
+        )
+
+    results = run(range(0, 1))
+    assert len(results) == 12
+    assert len(os.listdir(tmp_path / 'experiments')) == 1
+
+    results_extended = run(range(0, 2))
+    assert len(results_extended) == 24
+    assert results_extended[:12] == results
+    assert len(os.listdir(tmp_path / 'experiments')) == 2
+
+    # Adding an experiment with another AI doesn't change the keys of the experiments already run
+    cached_files = set(os.listdir(tmp_path / 'experiments'))
+    results_with_ai = run(range(0, 2), extra_experiments=({
+        'seed': 2,
+        'ais': (
+            local_file('./fixtures/54524149-trAIns-2.1.tar', 'trAIns'),
+        ),
+        'days': 366 * 1 + 1,
+    },))
+    assert results_with_ai[:24] == results_extended
+    assert set(os.listdir(tmp_path / 'experiments')) > cached_files
+    assert len(os.listdir(tmp_path / 'experiments')) == 3
+
+
+def test_experiment_cache_result_processor_key_does_not_depend_on_hash_seed():
+    # Functions defined in __main__ are pickled by value, and the order of a frozenset in the
+    # pickle depends on the hash seed
+    def key(hash_seed):
+        return subprocess.check_output((sys.executable, '-c', textwrap.dedent('''
+            import dill, openttdlab
+            result_processor = lambda row, tags=('PLYR',): ({'in': row['x'] in {'a', 'b', 'c', 'd', 'e', 'f'}},)
+            print(openttdlab._function_sha256(result_processor, dill.dumps(result_processor)))
+        ''')), env={**os.environ, 'PYTHONHASHSEED': str(hash_seed)})
+
+    assert key(1) == key(2)
+
+
+def test_run_experiments_savegame_deltas():
+    experiments = (
+        {
+            'seed': 0,
+            'ais': (
+                local_folder('./fixtures/NoOpAIImportingPathfinder-1', 'NoOpAIImportingPathfinder'),
+            ),
+            'days': 366 * 1 + 1,
+        },
+    )
+    ai_libraries = (
+        bananas_ai_library('5046524f', 'Pathfinder.Road'),
+    )
+    results = run_experiments(
+        experiments=experiments, ai_libraries=ai_libraries, openttd_version='13.4', opengfx_version='7.1',
+        chunk_tags=('PLYR',),
+    )
+    results_deltas = run_experiments(
+        experiments=experiments, ai_libraries=ai_libraries, openttd_version='13.4', opengfx_version='7.1',
+        chunk_tags=('PLYR',), savegame_deltas=True,
+    )
+
+    assert len(results_deltas) == len(results) == 12
+    savegame = None
+    for result, result_delta in zip(results, results_deltas):
+        assert result_delta['date'] == result['date']
+        savegame = apply_savegame_delta(savegame, result_delta)
+        assert {
+            tag: chunk['records'] for tag, chunk in savegame['chunks'].items()
+        } == result['chunks']
+
+
 def test_run_experiments_multiple_local_folder():
     with tempfile.TemporaryDirectory() as d:
         with tarfile.open('./fixtures/54524149-trAIns-2.1.tar', 'r') as f_tar:
@@ -701,3 +973,639 @@ def test_bananas_download_latest_version_custom_license():
     with download_from_bananas('ai/4349564c') as files:
         assert files[0][2] == 'Custom'
         assert len(files[0][3]) == 8
+
+
+def test_savegame_parser_reuses_compiled_decoders():
+    def parse():
+        with open('./fixtures/warbourne-cross-transport-2029-01-06.sav', 'rb') as f:
+            return parse_savegame(iter(lambda: f.read(65536), b''))
+
+    game_1 = parse()
+    game_2 = parse()
+
+    assert game_1 == game_2
+    game_1['chunks']['PLYR']['headers']['root'].clear()
+    assert game_2['chunks']['PLYR']['headers']['root'] == parse()['chunks']['PLYR']['headers']['root']
+
+
+def test_savegame_parser_chunk_tags():
+    with open('./fixtures/warbourne-cross-transport-2029-01-06.sav', 'rb') as f:
+        game = parse_savegame(iter(lambda: f.read(65536), b''))
+    with open('./fixtures/warbourne-cross-transport-2029-01-06.sav', 'rb') as f:
+        game_subset = parse_savegame(iter(lambda: f.read(65536), b''), chunk_tags=('DATE', 'PLYR', 'MAPT'))
+
+    assert game_subset['savegame_version'] == game['savegame_version']
+    assert game_subset['chunks'] == {
+        tag: game['chunks'][tag]
+        for tag in ('MAPT', 'DATE', 'PLYR')
+    }
+
+
+def test_query_savegame():
+    game = parse_savegame('./fixtures/warbourne-cross-transport-2029-01-06.sav')
+    values = query_savegame('./fixtures/warbourne-cross-transport-2029-01-06.sav', (
+        'DATE.0.date',
+        'PLYR.*.money',
+        'PLYR.0.cur_economy.income',
+        'PATS.0.difficulty.terrain_type',
+        'LGRP.*.nodes.xy',
+        'LGRP.1.nodes.edges.capacity',
+        'NGRF.0',
+        'PLYR.0.does_not_exist',
+    ))
+
+    assert values['DATE.0.date'] == game['chunks']['DATE']['records']['0']['date']
+    assert values['PLYR.0.money'] == 229296021
+    assert values['PLYR.0.cur_economy.income'] == [
+        economy['income'] for economy in game['chunks']['PLYR']['records']['0']['cur_economy']
+    ]
+    assert values['PATS.0.difficulty.terrain_type'] == game['chunks']['PATS']['records']['0']['difficulty.terrain_type']
+    assert {
+        path: value for path, value in values.items() if path.startswith('LGRP.') and path.endswith('.xy')
+    } == {
+        f'LGRP.{index}.nodes.xy': [node['xy'] for node in record['nodes']]
+        for index, record in game['chunks']['LGRP']['records'].items()
+    }
+    assert values['LGRP.1.nodes.edges.capacity'] == [
+        [edge['capacity'] for edge in node['edges']] for node in game['chunks']['LGRP']['records']['1']['nodes']
+    ]
+    assert values['NGRF.0'] == game['chunks']['NGRF']['records']['0']
+    assert 'PLYR.0.does_not_exist' not in values
+
+
+def test_query_savegame_field_name_with_dots_and_struct_list_with_same_prefix():
+    # The goods of stations have both a field named cargo.reserved_count and a list named cargo
+    game = parse_savegame('./fixtures/warbourne-cross-transport-2029-01-06.sav', chunk_tags=('STNN',))
+    values = query_savegame('./fixtures/warbourne-cross-transport-2029-01-06.sav', ('STNN.*.normal.goods.cargo.reserved_count',))
+
+    assert values == {
+        f'STNN.{index}.normal.goods.cargo.reserved_count': [
+            [goods['cargo.reserved_count'] for goods in normal['goods']] for normal in record['normal']
+        ]
+        for index, record in game['chunks']['STNN']['records'].items()
+    }
+    assert values['STNN.0.normal.goods.cargo.reserved_count'][0][5] == 180
+    assert 0 in values['STNN.0.normal.goods.cargo.reserved_count'][0]
+
+
+@pytest.mark.parametrize('compression', [b'OTTN', b'OTTX'])
+def test_inspect_savegame(tmp_path, compression):
+    with open('./fixtures/warbourne-cross-transport-2029-01-06.sav', 'rb') as f:
+        contents = f.read()
+    if compression == b'OTTN':
+        contents = b'OTTN' + contents[4:8] + lzma.decompress(contents[8:])
+    path = tmp_path / 'savegame.sav'
+    path.write_bytes(contents)
+    game = parse_savegame(path)
+
+    toc = inspect_savegame(path, sidecar=True)
+    assert toc['savegame_version'] == game['savegame_version']
+    assert toc['compression'] == compression.decode()
+    assert list(toc['chunks'].keys()) == list(game['chunks'].keys())
+    assert toc['chunks']['PLYR']['num_records'] == 1
+    assert toc['chunks']['VEHS']['num_records'] == len(game['chunks']['VEHS']['records'])
+    assert toc['chunks']['MAPT']['chunk_type'] == 0
+    assert sum(chunk['size'] for chunk in toc['chunks'].values()) + 4 == \
+        len(lzma.decompress(contents[8:]) if compression == b'OTTX' else contents[8:])
+
+    assert inspect_savegame(path, sidecar=True) == toc
+    assert os.path.exists(str(path) + '.toc.json')
+
+    assert parse_savegame(path, toc=toc) == game
+    assert parse_savegame(contents, toc=toc, chunk_tags=('PLYR',))['chunks'] == {'PLYR': game['chunks']['PLYR']}
+    assert parse_savegame_records(path, toc, 'VEHS', ('5', '2')) == {
+        record_index: game['chunks']['VEHS']['records'][record_index]
+        for record_index in ('2', '5')
+    }
+    with open(path, 'rb') as f:
+        with iter_savegame(iter(lambda: f.read(65536), b''), toc=toc, chunk_tags=('PLYR', 'VEHS')) as (_, chunks):
+            assert [tag for tag, _, _ in chunks] == ['VEHS', 'PLYR']
+
+    with open(path, 'rb') as f:
+        assert inspect_savegame(iter(lambda: f.read(65536), b'')) == toc
+
+    # The offsets are of the decompressed data, so the table of contents can be used with the same
+    # savegame compressed differently
+    with open('./fixtures/warbourne-cross-transport-2029-01-06.sav', 'rb') as f:
+        contents_ottx = f.read()
+    contents_ottn = b'OTTN' + contents_ottx[4:8] + lzma.decompress(contents_ottx[8:])
+    assert toc['decompressed_size'] == len(contents_ottn) - 8
+    for other_contents in (contents_ottn, contents_ottx):
+        assert parse_savegame(other_contents, toc=toc, chunk_tags=('PLYR',))['chunks'] == {'PLYR': game['chunks']['PLYR']}
+    with pytest.raises(ValidationException, match='does not match its table of contents'):
+        parse_savegame(contents_ottn + b'\0', toc=toc, chunk_tags=('PLYR',))
+
+
+def test_savegame_parser_cache(tmp_path, monkeypatch):
+    game = parse_savegame('./fixtures/warbourne-cross-transport-2029-01-06.sav')
+    cache_dir = tmp_path / 'parsed-savegames'
+
+    def cached_files():
+        return sorted(os.listdir(cache_dir))
+
+    assert parse_savegame('./fixtures/warbourne-cross-transport-2029-01-06.sav', parse_cache=True, get_cache_dir=lambda: str(tmp_path)) == game
+    assert len(cached_files()) == 1
+    with open('./fixtures/warbourne-cross-transport-2029-01-06.sav', 'rb') as f:
+        assert parse_savegame(iter(lambda: f.read(65536), b''), parse_cache=True, get_cache_dir=lambda: str(tmp_path)) == game
+    assert len(cached_files()) == 1
+
+    max_bytes = os.path.getsize(cache_dir / cached_files()[0])
+    game_subset = parse_savegame(
+        './fixtures/warbourne-cross-transport-2029-01-06.sav', chunk_tags=('PLYR',),
+        parse_cache=True, parse_cache_max_bytes=max_bytes, get_cache_dir=lambda: str(tmp_path),
+    )
+    assert game_subset['chunks'] == {'PLYR': game['chunks']['PLYR']}
+    assert len(cached_files()) == 1
+    assert parse_savegame(
+        './fixtures/warbourne-cross-transport-2029-01-06.sav', chunk_tags=('PLYR',),
+        parse_cache=True, get_cache_dir=lambda: str(tmp_path),
+    ) == game_subset
+
+    # The cache directory is only scanned again once the total size of the cache is over the limit
+    scanned_dirs = []
+    scandir = os.scandir
+
+    def counting_scandir(path):
+        scanned_dirs.append(path)
+        return scandir(path)
+
+    monkeypatch.setattr(os, 'scandir', counting_scandir)
+    for chunk_tags in (('DATE',), ('MAPS',)):
+        parse_savegame(
+            './fixtures/warbourne-cross-transport-2029-01-06.sav', chunk_tags=chunk_tags,
+            parse_cache=True, parse_cache_max_bytes=max_bytes + 1, get_cache_dir=lambda: str(tmp_path),
+        )
+    assert len(cached_files()) == 3
+    assert scanned_dirs == []
+    parse_savegame(
+        './fixtures/warbourne-cross-transport-2029-01-06.sav', parse_cache=True, parse_cache_max_bytes=max_bytes + 1,
+        get_cache_dir=lambda: str(tmp_path),
+    )
+    assert scanned_dirs == [str(cache_dir)]
+
+
+@pytest.mark.parametrize('compression', [b'OTTN', b'OTTZ', b'OTTX'])
+def test_savegame_parser_pipelined(tmp_path, compression):
+    with open('./fixtures/warbourne-cross-transport-2029-01-06.sav', 'rb') as f:
+        contents = f.read()
+    decompressed = lzma.decompress(contents[8:])
+    contents = \
+        b'OTTN' + contents[4:8] + decompressed if compression == b'OTTN' else \
+        b'OTTZ' + contents[4:8] + zlib.compress(decompressed) if compression == b'OTTZ' else \
+        contents
+    path = tmp_path / 'savegame.sav'
+    path.write_bytes(contents)
+    game = parse_savegame(contents)
+
+    assert parse_savegame(path, pipelined=True) == game
+    assert parse_savegame(contents, pipelined=True) == game
+
+    # Stopping early, or errors in decompression, must not leave the decompression thread blocked
+    with iter_savegame(path, pipelined=True) as (_, chunks):
+        next(iter(chunks))
+    with pytest.raises(Exception):
+        parse_savegame(contents[:len(contents) // 2], pipelined=True)
+
+
+def test_savegame_parser_stats():
+    with open('./fixtures/warbourne-cross-transport-2029-01-06.sav', 'rb') as f:
+        contents = f.read()
+    stats = {}
+    game = parse_savegame(
+        './fixtures/warbourne-cross-transport-2029-01-06.sav',
+        stats_callback=lambda tag, chunk_stats: stats.update({tag: chunk_stats}),
+    )
+
+    assert list(stats.keys()) == list(game['chunks'].keys())
+    assert stats['VEHS']['num_records'] == len(game['chunks']['VEHS']['records'])
+    assert sum(chunk_stats['decompressed_bytes'] for chunk_stats in stats.values()) + 4 == \
+        len(lzma.decompress(contents[8:]))
+    assert sum(chunk_stats['compressed_bytes'] for chunk_stats in stats.values()) > 0
+    for chunk_stats in stats.values():
+        assert chunk_stats['seconds'] == pytest.approx(chunk_stats['decompress_seconds'] + chunk_stats['decode_seconds'])
+
+
+def test_savegame_parser_max_workers():
+    with open('./fixtures/warbourne-cross-transport-2029-01-06.sav', 'rb') as f:
+        contents = f.read()
+    game = parse_savegame(contents)
+
+    game_parallel = parse_savegame(contents, max_workers=2)
+    assert game_parallel == game
+    assert list(game_parallel['chunks'].keys()) == list(game['chunks'].keys())
+    assert parse_savegame('./fixtures/warbourne-cross-transport-2029-01-06.sav', max_workers=2, chunk_tags=('PLYR', 'VEHS')) == \
+        parse_savegame(contents, chunk_tags=('PLYR', 'VEHS'))
+
+
+def test_iter_savegame():
+    with open('./fixtures/warbourne-cross-transport-2029-01-06.sav', 'rb') as f:
+        game = parse_savegame(iter(lambda: f.read(65536), b''))
+
+    tags = []
+    first_vehicle = None
+    with open('./fixtures/warbourne-cross-transport-2029-01-06.sav', 'rb') as f:
+        with iter_savegame(iter(lambda: f.read(65536), b'')) as (savegame_version, chunks):
+            for tag, headers, records in chunks:
+                tags.append(tag)
+                assert headers == game['chunks'][tag]['headers']
+                if tag == 'VEHS':
+                    first_vehicle = next(iter(records))
+                if tag == 'PLYR':
+                    companies = dict(records)
+                    break
+
+    assert savegame_version == game['savegame_version']
+    assert tags == list(game['chunks'].keys())[:len(tags)]
+    assert first_vehicle == next(iter(game['chunks']['VEHS']['records'].items()))
+    assert companies == game['chunks']['PLYR']['records']
+
+
+def test_savegame_parser_map_arrays():
+    with open('./fixtures/warbourne-cross-transport-2029-01-06.sav', 'rb') as f:
+        contents = f.read()
+    game = parse_savegame(contents, map_arrays=True)
+    decompressed = lzma.decompress(contents[8:])
+    toc = inspect_savegame(contents)
+
+    assert game['chunks']['MAPS']['records']['0'] == {'dim_x': 256, 'dim_y': 256}
+    for tag, dtype in (('MAPT', 'u1'), ('MAPH', 'u1'), ('MAPO', 'u1'), ('MAP2', '>u2'), ('MAP8', '>u2')):
+        tiles = game['chunks'][tag]['array']
+        assert tiles.shape == (256, 256)
+        assert tiles.dtype == dtype
+        offset = toc['chunks'][tag]['offset'] + 8
+        assert tiles.tobytes() == decompressed[offset:offset + 256 * 256 * tiles.dtype.itemsize]
+
+    # Tiles are in order along the x axis, and the edges of the map are void tiles
+    assert (game['chunks']['MAPT']['array'][0, :] >> 4 == 7).all()
+    assert (game['chunks']['MAPT']['array'][:, 0] >> 4 == 7).all()
+
+    game_subset = parse_savegame(contents, map_arrays=True, chunk_tags=('MAPH',))
+    assert list(game_subset['chunks'].keys()) == ['MAPH']
+    assert (game_subset['chunks']['MAPH']['array'] == game['chunks']['MAPH']['array']).all()
+    game_columns = parse_savegame(contents, map_arrays=True, chunk_tags=('MAPH',), output='columns')
+    assert (game_columns['chunks']['MAPH']['array'] == game['chunks']['MAPH']['array']).all()
+
+
+def test_link_graphs():
+    game = parse_savegame('./fixtures/warbourne-cross-transport-2029-01-06.sav', chunk_tags=('MAPS', 'LGRP'))
+    graphs = link_graphs('./fixtures/warbourne-cross-transport-2029-01-06.sav')
+
+    # Each link of each node in the savegame, other than the first edge of each node that is to
+    # itself, is in the graph of its cargo
+    links = {}
+    for record in game['chunks']['LGRP']['records'].values():
+        for node in record['nodes']:
+            for edge, previous_edge in zip(node['edges'][1:], node['edges']):
+                links[(record['cargo'], node['station'], record['nodes'][previous_edge['next_edge']]['station'])] = \
+                    (edge['capacity'], edge['usage'], edge['travel_time_sum'])
+    assert links
+    assert {
+        (cargo, graph['node_ids'][i], graph['node_ids'][j]): (capacity, usage, travel_time_sum)
+        for cargo, graph in graphs.items()
+        for i in range(0, len(graph['node_ids']))
+        for j, capacity, usage, travel_time_sum in zip(*(
+            graph[key][graph['indptr'][i]:graph['indptr'][i + 1]]
+            for key in ('indices', 'capacity', 'usage', 'travel_time_sum')
+        ))
+    } == links
+
+    for graph in graphs.values():
+        xy = [int(xy) for xy in graph['node_xy']]
+        assert [int(distance) for distance in graph['distance']] == [
+            abs(xy[i] % 256 - xy[j] % 256) + abs(xy[i] // 256 - xy[j] // 256)
+            for i in range(0, len(xy))
+            for j in graph['indices'][graph['indptr'][i]:graph['indptr'][i + 1]]
+        ]
+
+    for parsed in (game, parse_savegame('./fixtures/warbourne-cross-transport-2029-01-06.sav', chunk_tags=('MAPS', 'LGRP'), output='columns')):
+        graphs_from_parsed = link_graphs(parsed)
+        assert graphs_from_parsed.keys() == graphs.keys()
+        for cargo, graph in graphs.items():
+            for key, array in graph.items():
+                assert (graphs_from_parsed[cargo][key] == array).all()
+
+    # Edges of older savegames don't have travel_time_sum
+    for record in game['chunks']['LGRP']['records'].values():
+        for node in record['nodes']:
+            for edge in node['edges']:
+                del edge['travel_time_sum']
+    graphs_without_travel_time = link_graphs(game)
+    for cargo, graph in graphs.items():
+        assert 'travel_time_sum' not in graphs_without_travel_time[cargo]
+        assert (graphs_without_travel_time[cargo]['capacity'] == graph['capacity']).all()
+
+
+def test_diff_savegames():
+    with open('./fixtures/warbourne-cross-transport-2029-01-06.sav', 'rb') as f:
+        contents = f.read()
+    contents_ottn = b'OTTN' + contents[4:8] + lzma.decompress(contents[8:])
+    money = (229296021).to_bytes(8, 'big')
+    assert contents_ottn.count(money) == 1
+    contents_more_money = contents_ottn.replace(money, (229296022).to_bytes(8, 'big'))
+
+    deltas = list(diff_savegames([contents, contents_ottn, contents_more_money]))
+    assert all(
+        len(deltas[0]['chunks'][tag]['added']) == len(chunk['records'])
+        for tag, chunk in parse_savegame(contents)['chunks'].items()
+    )
+    assert deltas[1] == {'savegame_version': 299, 'chunks': {}, 'removed_chunks': []}
+    assert list(deltas[2]['chunks'].keys()) == ['PLYR']
+    assert deltas[2]['chunks']['PLYR']['added'] == {}
+    assert deltas[2]['chunks']['PLYR']['removed'] == []
+    assert deltas[2]['chunks']['PLYR']['changed']['0']['money'] == 229296022
+
+    savegame = None
+    for delta, expected_contents in zip(deltas, [contents, contents_ottn, contents_more_money]):
+        savegame = apply_savegame_delta(savegame, delta)
+        assert savegame == parse_savegame(expected_contents)
+
+
+def test_import_does_not_import_dependencies_not_needed_for_parsing():
+    imported = subprocess.check_output((sys.executable, '-c', (
+        'import sys; import openttdlab; '
+        'openttdlab.parse_savegame("./fixtures/warbourne-cross-transport-2029-01-06.sav"); '
+        'print(" ".join(sorted(sys.modules)))'
+    )), text=True).split()
+    for module in ('httpx', 'yaml', 'rich', 'dill', 'platformdirs', 'numpy'):
+        assert module not in imported
+
+
+def test_savegame_parser_lazy():
+    game = parse_savegame('./fixtures/warbourne-cross-transport-2029-01-06.sav')
+    decoded_tags = []
+    game_lazy = parse_savegame(
+        './fixtures/warbourne-cross-transport-2029-01-06.sav', lazy=True,
+        stats_callback=lambda tag, stats: decoded_tags.append(tag),
+    )
+
+    assert game_lazy['savegame_version'] == 299
+    assert list(game_lazy['chunks'].keys()) == list(game['chunks'].keys())
+    assert decoded_tags == []
+    assert game_lazy['chunks']['PLYR']['records']['0']['money'] == 229296021
+    assert game_lazy['chunks']['PLYR']['records'] is game_lazy['chunks']['PLYR']['records']
+    assert decoded_tags == ['PLYR']
+    assert 'NOPE' not in game_lazy['chunks']
+
+    assert game_lazy == game
+    assert pickle.loads(pickle.dumps(game_lazy)) == game
+    assert type(pickle.loads(pickle.dumps(game_lazy))['chunks']) is dict
+
+    toc = inspect_savegame('./fixtures/warbourne-cross-transport-2029-01-06.sav')
+    game_lazy_toc = parse_savegame('./fixtures/warbourne-cross-transport-2029-01-06.sav', lazy=True, toc=toc)
+    assert game_lazy_toc['chunks']['PLYR']['records'] == game['chunks']['PLYR']['records']
+
+    game_lazy_compact = parse_savegame('./fixtures/warbourne-cross-transport-2029-01-06.sav', lazy=True, compact_records=True, chunk_tags=('PLYR',))
+    assert list(game_lazy_compact['chunks'].keys()) == ['PLYR']
+    assert isinstance(game_lazy_compact['chunks']['PLYR']['records']['0'], CompactRecord)
+
+    with pytest.raises(ValueError):
+        parse_savegame('./fixtures/warbourne-cross-transport-2029-01-06.sav', lazy=True, output='columns')
+
+
+def test_savegame_parser_compact_records():
+    game = parse_savegame('./fixtures/warbourne-cross-transport-2029-01-06.sav')
+    game_compact = parse_savegame('./fixtures/warbourne-cross-transport-2029-01-06.sav', compact_records=True)
+
+    def to_dicts_and_lists(value):
+        return \
+            {key: to_dicts_and_lists(sub_value) for key, sub_value in value.items()} if isinstance(value, (dict, CompactRecord)) else \
+            [to_dicts_and_lists(sub_value) for sub_value in value] if isinstance(value, (list, tuple)) else \
+            value
+
+    assert to_dicts_and_lists(game_compact) == to_dicts_and_lists(game)
+
+    company = game_compact['chunks']['PLYR']['records']['0']
+    assert isinstance(company, CompactRecord)
+    assert company['money'] == 229296021
+    assert company.get('not_a_field') is None
+    assert 'money' in company
+    assert list(company) == list(game['chunks']['PLYR']['records']['0'].keys())
+    assert dict(company)['money'] == 229296021
+    assert pickle.loads(pickle.dumps(company)) == company
+    assert len(company) == len(game['chunks']['PLYR']['records']['0'])
+    assert isinstance(company, Mapping)
+    assert not isinstance(company, Sequence)
+
+    # A CompactRecord is not a dict, so JSON encoders don't encode it without converting it first
+    with pytest.raises(TypeError):
+        json.dumps(company)
+    assert json.loads(json.dumps(dict(company), default=str))['money'] == 229296021
+
+    # All records of the same table header share the same schema of field names
+    vehicles = list(game_compact['chunks']['VEHS']['records'].values())
+    assert all(vehicle._schema is vehicles[0]._schema for vehicle in vehicles)
+
+
+def test_savegame_parser_columns():
+    with open('./fixtures/warbourne-cross-transport-2029-01-06.sav', 'rb') as f:
+        game = parse_savegame(iter(lambda: f.read(65536), b''))
+    with open('./fixtures/warbourne-cross-transport-2029-01-06.sav', 'rb') as f:
+        game_columns = parse_savegame(iter(lambda: f.read(65536), b''), output='columns')
+
+    assert game_columns['savegame_version'] == game['savegame_version']
+    assert game_columns['chunks']['MAPT']['columns'] == {}
+    assert game_columns['chunks']['VEHS']['headers'] == game['chunks']['VEHS']['headers']
+
+    companies = game_columns['chunks']['PLYR']
+    assert companies['index'].tolist() == [int(index) for index in game['chunks']['PLYR']['records']]
+    assert companies['columns']['money'].dtype.kind == 'i'
+    assert companies['columns']['money'].tolist() == [record['money'] for record in game['chunks']['PLYR']['records'].values()]
+    assert companies['columns']['name'].tolist() == [record['name'] for record in game['chunks']['PLYR']['records'].values()]
+
+    link_graphs = game_columns['chunks']['LGRP']['columns']
+    nodes = [node for record in game['chunks']['LGRP']['records'].values() for node in record['nodes']]
+    edges = [edge for node in nodes for edge in node['edges']]
+    assert link_graphs['nodes.offsets'].tolist() == [0] + list(itertools.accumulate(
+        len(record['nodes']) for record in game['chunks']['LGRP']['records'].values()
+    ))
+    assert link_graphs['nodes.xy'].tolist() == [node['xy'] for node in nodes]
+    assert link_graphs['nodes.edges.offsets'].tolist() == [0] + list(itertools.accumulate(len(node['edges']) for node in nodes))
+    assert link_graphs['nodes.edges.travel_time_sum'].tolist() == [edge['travel_time_sum'] for edge in edges]
+
+    animated_tiles = game_columns['chunks']['ANIT']['columns']
+    assert animated_tiles['tiles'].tolist() == game['chunks']['ANIT']['records']['0']['tiles']
+    assert animated_tiles['tiles.offsets'].tolist() == [0, len(game['chunks']['ANIT']['records']['0']['tiles'])]
+
+
+@pytest.mark.parametrize(
+    "compression",
+    (b'OTTN', b'OTTX'),
+)
+def test_savegame_parser_path_and_bytes(tmp_path, compression):
+    with open('./fixtures/warbourne-cross-transport-2029-01-06.sav', 'rb') as f:
+        contents = f.read()
+    game = parse_savegame(iter((contents,)))
+
+    if compression == b'OTTN':
+        contents = b'OTTN' + contents[4:8] + lzma.decompress(contents[8:])
+    path = tmp_path / 'savegame.sav'
+    path.write_bytes(contents)
+
+    assert parse_savegame(str(path)) == game
+    assert parse_savegame(path, chunk_tags=('PLYR',))['chunks']['PLYR'] == game['chunks']['PLYR']
+    assert parse_savegame(contents) == game
+    assert parse_savegame(memoryview(contents)) == game
+
+
+def test_parse_savegames(tmp_path):
+    with open('./fixtures/warbourne-cross-transport-2029-01-06.sav', 'rb') as f:
+        contents = f.read()
+    paths = [str(tmp_path / f'{i}.sav') for i in range(0, 5)]
+    for path in paths:
+        with open(path, 'wb') as f:
+            f.write(contents)
+
+    results = list(parse_savegames(
+        (path for path in paths),
+        max_workers=2,
+        chunk_tags=('PLYR',),
+        result_processor=lambda row: ({
+            'path': row['path'],
+            'date': row['date'],
+            'tags': sorted(row['chunks'].keys()),
+            'money': row['chunks']['PLYR']['0']['money'],
+        },),
+    ))
+
+    assert sorted(results, key=lambda result: result['path']) == [
+        {
+            'path': path,
+            'date': date(2029, 1, 6),
+            'tags': ['DATE', 'PLYR'],
+            'money': 229296021,
+        }
+        for path in paths
+    ]
+
+    results = list(parse_savegames(paths[:1], max_workers=1, fields=('PLYR.*.money',)))
+    assert results[0]['fields'] == {'PLYR.0.money': 229296021}
+    assert results[0]['date'] == date(2029, 1, 6)
+
+    results = list(parse_savegames(paths[:1], max_workers=1, lazy=True, result_processor=lambda row: ({
+        'money': row['chunks']['PLYR']['0']['money'],
+    }, row)))
+    assert results[0] == {'money': 229296021}
+    assert type(results[1]['chunks']) is dict
+    assert results[1]['chunks']['PLYR'] == parse_savegame(paths[0])['chunks']['PLYR']['records']
+
+    rows = parse_savegames(paths, max_workers=1, chunk_tags=('PLYR',))
+    assert next(rows)['date'] == date(2029, 1, 6)
+    rows.close()
+
+
+@pytest.mark.parametrize('archive_name, mode', [
+    ('saves.tar', 'w:'),
+    ('saves.tar.xz', 'w:xz'),
+    ('saves.zip', None),
+])
+def test_parse_savegames_archive(tmp_path, archive_name, mode):
+    archive_path = str(tmp_path / archive_name)
+    member_names = ['save/autosave/0.sav', 'save/autosave/1.SAV']
+    if mode is None:
+        with zipfile.ZipFile(archive_path, 'w', compression=zipfile.ZIP_DEFLATED) as f_zip:
+            f_zip.writestr('save/readme.txt', 'Not a savegame')
+            for member_name in member_names:
+                f_zip.write('./fixtures/warbourne-cross-transport-2029-01-06.sav', member_name)
+    else:
+        with tarfile.open(archive_path, mode) as f_tar:
+            for member_name in member_names:
+                f_tar.add('./fixtures/warbourne-cross-transport-2029-01-06.sav', member_name)
+
+    results = list(parse_savegames(
+        (archive_path,),
+        max_workers=2,
+        chunk_tags=('PLYR',),
+        result_processor=lambda row: ({
+            'path': row['path'],
+            'money': row['chunks']['PLYR']['0']['money'],
+        },),
+    ))
+
+    assert sorted(results, key=lambda result: result['path']) == [
+        {
+            'path': os.path.join(archive_path, member_name),
+            'money': 229296021,
+        }
+        for member_name in member_names
+    ]
+
+
+def test_parse_savegames_command_line(tmp_path):
+    output_path = str(tmp_path / 'output.jsonl')
+    subprocess.check_output((
+        sys.executable, '-m', 'openttdlab', 'parse', './fixtures',
+        '--output', output_path, '--chunk-tags', 'PLYR', '--max-workers', '1',
+    ))
+
+    with open(output_path, 'r', encoding='utf-8') as f:
+        rows = [json.loads(line) for line in f]
+
+    assert len(rows) == 1
+    assert rows[0]['date'] == '2029-01-06'
+    assert rows[0]['chunks']['PLYR']['0']['money'] == 229296021
+
+
+def test_parse_savegames_command_line_compact_records(tmp_path):
+    output_path = str(tmp_path / 'output.jsonl')
+    subprocess.check_output((
+        sys.executable, '-m', 'openttdlab', 'parse', './fixtures',
+        '--output', output_path, '--chunk-tags', 'PLYR', '--max-workers', '1', '--compact-records',
+    ))
+
+    with open(output_path, 'r', encoding='utf-8') as f:
+        rows = [json.loads(line) for line in f]
+
+    assert rows[0]['chunks']['PLYR']['0']['money'] == 229296021
+    assert rows[0]['chunks']['PLYR'] == json.loads(json.dumps(
+        parse_savegame('./fixtures/warbourne-cross-transport-2029-01-06.sav', chunk_tags=('PLYR',))['chunks']['PLYR']['records'],
+        default=str,
+    ))
+
+
+def test_jsonl_sink_compact_records(tmp_path):
+    row = parse_savegame('./fixtures/warbourne-cross-transport-2029-01-06.sav', chunk_tags=('PLYR',), compact_records=True)
+    assert isinstance(row['chunks']['PLYR']['records']['0'], CompactRecord)
+
+    open_writer, read_rows = jsonl_sink(str(tmp_path / 'results.jsonl'))
+    with open_writer() as write:
+        write(0, [{'chunks': row['chunks']}])
+
+    rows = list(read_rows())
+    assert rows[0]['experiment_index'] == 0
+    assert rows[0]['chunks']['PLYR']['records']['0']['money'] == 229296021
+    assert rows[0]['chunks']['PLYR']['records'] == json.loads(json.dumps(
+        parse_savegame('./fixtures/warbourne-cross-transport-2029-01-06.sav', chunk_tags=('PLYR',))['chunks']['PLYR']['records'],
+        default=str,
+    ))
+
+
+def test_parquet_sink_values_not_in_parquet(tmp_path):
+    pytest.importorskip('pyarrow')
+    row = parse_savegame('./fixtures/warbourne-cross-transport-2029-01-06.sav', chunk_tags=('PLYR',), compact_records=True)
+
+    open_writer, read_rows = parquet_sink(str(tmp_path / 'results'))
+    with open_writer() as write:
+        write(0, [{
+            'experiment': {'seed': 1, 'ais': (('NoOpAI', (('a', 1),)),)},
+            'date': date(2029, 1, 6),
+            'company': row['chunks']['PLYR']['records']['0'],
+        }])
+
+    rows = list(read_rows())
+    assert json.loads(rows[0]['experiment']) == {'seed': 1, 'ais': [['NoOpAI', [['a', 1]]]]}
+    assert rows[0]['date'] == date(2029, 1, 6)
+    assert json.loads(rows[0]['company'])['money'] == 229296021
+
+
+def test_parse_savegames_command_line_parquet(tmp_path):
+    pq = pytest.importorskip('pyarrow.parquet')
+    output_path = str(tmp_path / 'output.parquet')
+    subprocess.check_output((
+        sys.executable, '-m', 'openttdlab', 'parse', './fixtures/warbourne-cross-transport-2029-01-06.sav',
+        '--output', output_path, '--format', 'parquet', '--chunk-tags', 'PLYR',
+    ))
+
+    rows = pq.read_table(output_path).to_pylist()
+    assert [(row['tag'], row['index']) for row in rows] == [('DATE', '0'), ('PLYR', '0')]
+    assert rows[1]['date'] == date(2029, 1, 6)
+    assert json.loads(rows[1]['record'])['money'] == 229296021